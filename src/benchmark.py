@@ -0,0 +1,324 @@
+import argparse
+import json
+import time
+
+from replace_id import (
+    DatabaseUtils, HashUuidStrategy, IdReplacer, OnlineIdReplacer, OrderPreservingUuidStrategy, RandomUuidStrategy,
+    RebuildIdReplacer, SingleRewriteIdReplacer, TimeOrderedUuidStrategy, Utils
+)
+
+ENGINES = {
+    'IdReplacer': IdReplacer,
+    'SingleRewriteIdReplacer': SingleRewriteIdReplacer,
+    'OnlineIdReplacer': OnlineIdReplacer,
+    'RebuildIdReplacer': RebuildIdReplacer,
+}
+
+STRATEGIES = {
+    'random': RandomUuidStrategy,
+    'hash': HashUuidStrategy,
+    'time': TimeOrderedUuidStrategy,
+    'order': OrderPreservingUuidStrategy,
+}
+
+
+class SchemaGenerator:
+    """
+    Generate a synthetic schema, with integer keys, to benchmark the conversions.
+
+    The tables t1 ... tN have an integer PK, a payload and FK columns to the previous tables: one to the previous
+    table (chain) and fan_out more to the preceding tables. Optionally, a self reference (parent_id) and indexes
+    over the payload columns.
+    """
+
+    def __init__(self, tables=10, rows=10000, fan_out=1, chain=True, self_reference=False, indexes=1, seed=0.5):
+        """
+        :param tables: number of tables.
+        :param rows: rows of each table.
+        :param fan_out: FK columns of each table to the preceding tables, besides the chain.
+        :param chain: each table references the previous one.
+        :param self_reference: each table references itself (parent_id).
+        :param indexes: secondary indexes of each table over the payload columns (the FK columns are always
+        indexed).
+        :param seed: the seed (between -1 and 1) of the generated values, for reproducible runs.
+        """
+        self.tables = tables
+        self.rows = rows
+        self.fan_out = fan_out
+        self.chain = chain
+        self.self_reference = self_reference
+        self.indexes = indexes
+        self.seed = seed
+
+    def _build_table_name(self, index):
+        return 't%d' % index
+
+    def _get_references(self, index):
+        """
+        The tables referenced by the table, in order.
+        """
+        references = []
+        if self.chain and index > 1:
+            references.append(index - 1)
+        for step in range(1, self.fan_out + 1):
+            referenced = index - 1 - step
+            if referenced >= 1 and referenced not in references:
+                references.append(referenced)
+        return references
+
+    def _build_sql_to_create_table(self, index):
+        table_name = self._build_table_name(index)
+        columns = [
+            'id serial primary key',
+            'payload_0 text not null',
+            'payload_1 integer not null',
+            'created_at timestamp not null default now()',
+        ]
+        for referenced in self._get_references(index):
+            columns.append('{column_name} integer references {referenced_name} (id)'.format(
+                column_name='%s_id' % self._build_table_name(referenced),
+                referenced_name=self._build_table_name(referenced),
+            ))
+        if self.self_reference:
+            columns.append('parent_id integer references {table_name} (id)'.format(table_name=table_name))
+        sql = """
+        create table {table_name} (
+          {columns}
+        );
+        """.format(
+            table_name=table_name,
+            columns=',\n          '.join(columns),
+        )
+        return sql
+
+    def _build_sql_to_fill_table(self, index):
+        table_name = self._build_table_name(index)
+        columns = ['payload_0', 'payload_1']
+        values = ['md5(random()::text)', '(random() * 1000000)::integer']
+        for referenced in self._get_references(index):
+            columns.append('%s_id' % self._build_table_name(referenced))
+            values.append('1 + floor(random() * {rows})::integer'.format(rows=self.rows))
+        if self.self_reference:
+            columns.append('parent_id')
+            values.append('case when i > 1 then 1 + floor(random() * (i - 1))::integer end')
+        sql = """
+        insert into {table_name} ({columns})
+        select {values} from generate_series(1, {rows}) as i;
+        """.format(
+            table_name=table_name,
+            columns=', '.join(columns),
+            values=', '.join(values),
+            rows=self.rows,
+        )
+        return sql
+
+    def _build_sql_to_create_indexes(self, index):
+        table_name = self._build_table_name(index)
+        columns = ['%s_id' % self._build_table_name(referenced) for referenced in self._get_references(index)]
+        if self.self_reference:
+            columns.append('parent_id')
+        payloads = ['payload_0', 'payload_1', 'payload_0, payload_1', 'created_at']
+        columns.extend(payloads[i % len(payloads)] for i in range(self.indexes))
+        return ''.join(
+            'create index {table_name}_idx{number} on {table_name} ({columns});\n'.format(
+                table_name=table_name,
+                number=number,
+                columns=column,
+            )
+            for number, column in enumerate(columns)
+        )
+
+    def generate(self, connection, schema):
+        """
+        Drop and create the schema with the tables, rows and indexes.
+        """
+        utils = DatabaseUtils()
+        utils.execute(connection, 'drop schema if exists {schema} cascade; create schema {schema};'.format(
+            schema=schema,
+        ))
+        utils.execute(connection, 'create extension if not exists pgcrypto;')
+        utils.execute(connection, 'set search_path to {schema}, public;'.format(schema=schema))
+        utils.execute(connection, 'select setseed({seed});'.format(seed=self.seed))
+        for index in range(1, self.tables + 1):
+            Utils.print_message("...generating " + self._build_table_name(index))
+            utils.execute(connection, self._build_sql_to_create_table(index))
+            utils.execute(connection, self._build_sql_to_fill_table(index))
+            utils.execute(connection, self._build_sql_to_create_indexes(index))
+        utils.execute(connection, 'analyze;')
+
+
+class Benchmark:
+    """
+    Run the conversion engines over freshly generated schemas and collect, for each run, the per phase timings,
+    the WAL generated and the final table / index sizes.
+
+    The conversions are restricted to the generated schema (include_schemas), which is dropped and recreated by
+    each run.
+    """
+
+    def __init__(self, params, generator):
+        """
+        :param params: the params of the conversions (connection, workers, batch_size, uuid_strategy, etc.).
+        :param generator: the SchemaGenerator.
+        """
+        self.params = params
+        self.generator = generator
+
+    def _get_wal_lsn(self, connection):
+        return DatabaseUtils().select(connection, 'select pg_current_wal_lsn() as lsn;')[0]['lsn']
+
+    def _get_wal_bytes(self, connection, start_lsn):
+        sql = "select pg_wal_lsn_diff(pg_current_wal_lsn(), '{lsn}') as wal_bytes;".format(lsn=start_lsn)
+        return int(DatabaseUtils().select(connection, sql)[0]['wal_bytes'])
+
+    def _get_sizes(self, connection, schema):
+        sql = """
+        select
+          coalesce(sum(pg_table_size(c.oid)), 0) as table_bytes,
+          coalesce(sum(pg_indexes_size(c.oid)), 0) as index_bytes
+        from pg_class c
+        inner join pg_namespace n on n.oid = c.relnamespace
+        where n.nspname = '{schema}' and c.relkind in ('r', 'p');
+        """.format(
+            schema=schema,
+        )
+        row = DatabaseUtils().select(connection, sql)[0]
+        return {'table_bytes': int(row['table_bytes']), 'index_bytes': int(row['index_bytes'])}
+
+    def _build_replacer(self, engine, phases):
+        class BenchmarkReplacer(engine):
+            def on_phase(self, record):
+                phases.append(record)
+
+        return BenchmarkReplacer()
+
+    def run_engine(self, engine):
+        """
+        Generate the schema and convert it with the engine.
+        :return: a dict with the measures of the run.
+        """
+        schema = self.params['schema']
+        params = dict(self.params, instrumentation=True, autocommit=True, include_schemas=[schema])
+        utils = DatabaseUtils()
+        connection = utils.get_connection(params)
+        try:
+            self.generator.generate(connection, schema)
+            before = self._get_sizes(connection, schema)
+            phases = []
+            replacer = self._build_replacer(engine, phases)
+            start_lsn = self._get_wal_lsn(connection)
+            start_time = time.time()
+            replacer.execute(params=params)
+            seconds = time.time() - start_time
+            wal_bytes = self._get_wal_bytes(connection, start_lsn)
+            utils.execute(connection, 'analyze;')
+            after = self._get_sizes(connection, schema)
+        finally:
+            connection.close()
+        return {
+            'engine': engine.__name__,
+            'seconds': round(seconds, 3),
+            'wal_bytes': wal_bytes,
+            'before': before,
+            'after': after,
+            'phases': phases,
+        }
+
+    def run(self, engines, repeat=1):
+        """
+        Run each engine repeat times.
+        :return: the list of the measures of the runs.
+        """
+        results = []
+        for engine in engines:
+            for run in range(repeat):
+                Utils.print_message("Benchmark of %s (run %d)" % (engine.__name__, run + 1))
+                result = self.run_engine(engine)
+                result['run'] = run + 1
+                results.append(result)
+        return results
+
+    def print_report(self, results):
+        for result in results:
+            print('%s (run %d): %s, WAL %s, tables %s => %s, indexes %s => %s' % (
+                result['engine'],
+                result['run'],
+                Utils.to_hour_minute_second(result['seconds']),
+                self._format_bytes(result['wal_bytes']),
+                self._format_bytes(result['before']['table_bytes']),
+                self._format_bytes(result['after']['table_bytes']),
+                self._format_bytes(result['before']['index_bytes']),
+                self._format_bytes(result['after']['index_bytes']),
+            ))
+            for phase in result['phases']:
+                print('    %-60s %10.3fs %12s' % (
+                    phase['step'], phase['seconds'], self._format_bytes(phase['wal_bytes'])
+                ))
+
+    def _format_bytes(self, value):
+        for unit in ['B', 'kB', 'MB', 'GB']:
+            if abs(value) < 1024:
+                return '%.1f %s' % (value, unit)
+            value /= 1024.0
+        return '%.1f TB' % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the int to uuid conversions over a synthetic schema.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='postgres')
+    parser.add_argument('--db-name', required=True, help='only the keys of --schema are converted')
+    parser.add_argument('--schema', default='pk2uuid_benchmark', help='dropped and recreated by each run')
+    parser.add_argument('--serial-name', default='serial_id')
+    parser.add_argument('--tables', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--fan-out', type=int, default=1)
+    parser.add_argument('--no-chain', action='store_true')
+    parser.add_argument('--self-reference', action='store_true')
+    parser.add_argument('--indexes', type=int, default=1)
+    parser.add_argument('--seed', type=float, default=0.5)
+    parser.add_argument('--engines', default='IdReplacer', help='comma separated: %s' % ', '.join(ENGINES))
+    parser.add_argument('--strategy', default='random', choices=sorted(STRATEGIES))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--fk-backfill', default='join', choices=['join', 'mapping'])
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', help='JSON file that receives the measures')
+    arguments = parser.parse_args()
+
+    params = {
+        'host': arguments.host,
+        'port': arguments.port,
+        'user': arguments.user,
+        'password': arguments.password,
+        'schema': arguments.schema,
+        'db_name': arguments.db_name,
+        'serial_name': arguments.serial_name,
+        'autocommit': True,
+        'workers': arguments.workers,
+        'fk_backfill': arguments.fk_backfill,
+        'uuid_strategy': STRATEGIES[arguments.strategy](),
+    }
+    if arguments.batch_size:
+        params['batch_size'] = arguments.batch_size
+    generator = SchemaGenerator(
+        tables=arguments.tables,
+        rows=arguments.rows,
+        fan_out=arguments.fan_out,
+        chain=not arguments.no_chain,
+        self_reference=arguments.self_reference,
+        indexes=arguments.indexes,
+        seed=arguments.seed,
+    )
+    benchmark = Benchmark(params, generator)
+    results = benchmark.run([ENGINES[name.strip()] for name in arguments.engines.split(',')], arguments.repeat)
+    benchmark.print_report(results)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
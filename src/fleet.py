@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import time
+import traceback
+
+from replace_id import DatabaseUtils, IdReplacer, SchemaGraph, Utils
+
+
+def run_target(replacer_class, params):
+    """
+    Convert one target, in a worker process. The errors are returned, not raised, so a failed target does not
+    stop the others.
+    :return: a dict with status (done or failed), seconds and error.
+    """
+    start_time = time.time()
+    try:
+        replacer_class().execute(params=params)
+        status, error = 'done', None
+    except Exception as e:
+        status, error = 'failed', '%s\n%s' % (e, traceback.format_exc())
+    return {'status': status, 'seconds': round(time.time() - start_time, 3), 'error': error}
+
+
+class FleetRunner:
+    """
+    Convert many databases (or schemas) with identical tables, in a pool of processes.
+
+    The keys are discovered once, in the schema of the first target (or read from the snapshot file), and reused
+    by every target: for targets in another schema, the keys of the schema of the first target are moved to it.
+    Each target checks, before changing anything, that its keys and the indexes over them are the same ones.
+    """
+
+    def __init__(self, replacer_class=IdReplacer, processes=4):
+        """
+        :param replacer_class: the IdReplacer (sub)class that converts each target. It must be importable by the
+        worker processes (defined in a module, not in an interactive session).
+        :param processes: the number of targets converted at the same time.
+        """
+        self.replacer_class = replacer_class
+        self.processes = processes
+
+    def _get_target_name(self, params):
+        return '%s:%s/%s/%s' % (params['host'], params['port'], params['db_name'], params['schema'])
+
+    def _discover(self, params, snapshot_file=None):
+        """
+        Read the keys of the schema of a target (or load them from the snapshot file) into a SchemaGraph. The
+        snapshot file receives the keys of that schema only, without the oids (that belong to the target database).
+        """
+        if snapshot_file is not None and os.path.exists(snapshot_file):
+            schema_graph = SchemaGraph.load(snapshot_file)
+        else:
+            replacer = self.replacer_class()
+            connection = DatabaseUtils().get_connection(params)
+            try:
+                replacer._discover(connection, params=params)
+            finally:
+                connection.close()
+            schema_graph = replacer.schema_graph
+        schema = params['schema']
+        schema_graph = schema_graph.filter(include_schemas=[schema]).drop_oids()
+        outside = [
+            '%s.%s' % (table['table_schema'], table['table_name']) for table in schema_graph.tables.values()
+            if table['table_schema'] != schema
+        ]
+        if outside:
+            raise Exception('The tables %s, out of the schema %s, reference its keys' % (', '.join(outside), schema))
+        if snapshot_file is not None:
+            schema_graph.save(snapshot_file)
+        return schema_graph
+
+    def _build_target_params(self, params, schema_graph, schema):
+        if params['schema'] != schema:
+            schema_graph = schema_graph.rename_schema(schema, params['schema'])
+        return dict(params, schema_graph=schema_graph)
+
+    def run(self, targets, snapshot_file=None, report_file=None):
+        """
+        Convert the targets.
+        :param targets: a list of params (see IdReplacer.execute), one for each database / schema.
+        :param snapshot_file: a snapshot file (see SchemaGraph) with the keys, read if it exists or written.
+        :param report_file: a JSON file that receives the report.
+        :return: the report: a dict with the number of targets done and failed, the seconds and, for each target,
+        the status, seconds and error.
+        """
+        start_time = time.time()
+        Utils.print_message("Discovering the keys in " + self._get_target_name(targets[0]))
+        schema_graph = self._discover(targets[0], snapshot_file)
+        results = []
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            futures = {}
+            for params in targets:
+                target_params = self._build_target_params(params, schema_graph, targets[0]['schema'])
+                futures[executor.submit(run_target, self.replacer_class, target_params)] = params
+            for future in as_completed(futures):
+                name = self._get_target_name(futures[future])
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'status': 'failed', 'seconds': None, 'error': str(e)}
+                result['target'] = name
+                results.append(result)
+                Utils.print_message("...%s %s" % (name, result['status']))
+        report = {
+            'done': sum(1 for result in results if result['status'] == 'done'),
+            'failed': sum(1 for result in results if result['status'] == 'failed'),
+            'seconds': round(time.time() - start_time, 3),
+            'targets': sorted(results, key=lambda result: result['target']),
+        }
+        Utils.print_message("Fleet finished: %d done, %d failed in %s" % (
+            report['done'], report['failed'], Utils.to_hour_minute_second(report['seconds'])
+        ))
+        if report_file is not None:
+            with open(report_file, 'w') as output:
+                json.dump(report, output, indent=2)
+        return report
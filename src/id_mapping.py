@@ -0,0 +1,140 @@
+import mmap
+import struct
+import uuid
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'PK2UUID1'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<q16s')
+
+
+class IdMappingExporter:
+    """
+    Export the old id => uuid mapping of a converted table (the serial column and the new PK) to a binary file:
+    a header (magic, number of records) followed by the records (old id as int64 little endian, uuid as 16 bytes),
+    sorted by the old id.
+    """
+
+    def __init__(self, fetch_size=10000):
+        """
+        :param fetch_size: the rows fetched at a time from the server (the rows are streamed by a named cursor).
+        """
+        self.fetch_size = fetch_size
+
+    def export(self, connection, table_name, id_column, uuid_column, file_name):
+        """
+        :param table_name: the table (schema.table).
+        :param id_column: the column with the old id (the serial column).
+        :param uuid_column: the column with the new uuid (the PK).
+        :return: the number of records written.
+        """
+        autocommit = connection.autocommit
+        if autocommit:
+            # named cursors only live inside a transaction
+            connection.autocommit = False
+        try:
+            cursor = connection.cursor(name='pk2uuid_id_mapping')
+            cursor.itersize = self.fetch_size
+            cursor.execute(
+                'select "{id_column}", "{uuid_column}"::text from {table_name} where "{id_column}" is not null '
+                'order by "{id_column}";'.format(
+                    table_name=table_name,
+                    id_column=id_column,
+                    uuid_column=uuid_column,
+                )
+            )
+            count = 0
+            with open(file_name, 'wb') as output:
+                output.write(HEADER.pack(MAGIC, 0))
+                for old_id, value in cursor:
+                    output.write(RECORD.pack(old_id, uuid.UUID(value).bytes))
+                    count += 1
+                output.seek(0)
+                output.write(HEADER.pack(MAGIC, count))
+            cursor.close()
+        finally:
+            if autocommit:
+                connection.rollback()
+                connection.autocommit = True
+        return count
+
+
+class IdMapping:
+    """
+    Look up the uuids of old ids in a file written by IdMappingExporter. The file is memory mapped: the lookups
+    are binary searches over the sorted records, only the touched pages are read into memory.
+    """
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise Exception('Not an id mapping file: %s' % file_name)
+        self.records = None
+        if numpy is not None:
+            dtype = numpy.dtype([('id', '<i8'), ('uuid', 'V16')])
+            self.records = numpy.frombuffer(self.map, dtype=dtype, count=self.count, offset=HEADER.size)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, old_id):
+        return self.lookup(old_id) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.records = None
+        self.map.close()
+        self.file.close()
+
+    def _get_id(self, index):
+        return struct.unpack_from('<q', self.map, HEADER.size + index * RECORD.size)[0]
+
+    def _find(self, old_id):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_id(middle) < old_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._get_id(low) == old_id:
+            return low
+        return None
+
+    def lookup(self, old_id):
+        """
+        :return: the uuid of the old id, or None when the id is not in the mapping.
+        """
+        index = self._find(int(old_id))
+        if index is None:
+            return None
+        start = HEADER.size + index * RECORD.size + 8
+        return uuid.UUID(bytes=bytes(self.map[start:start + 16]))
+
+    def lookup_many(self, old_ids):
+        """
+        Look up many old ids at once (vectorized with numpy, when it is installed).
+        :return: a list with the uuid (or None) of each old id, in the same order.
+        """
+        if self.records is None:
+            return [self.lookup(old_id) for old_id in old_ids]
+        ids = numpy.asarray(old_ids, dtype='<i8')
+        indexes = numpy.searchsorted(self.records['id'], ids)
+        found = indexes < self.count
+        found[found] = self.records['id'][indexes[found]] == ids[found]
+        values = self.records['uuid'][indexes[found]]
+        result = [None] * len(ids)
+        for position, value in zip(numpy.nonzero(found)[0], values):
+            result[position] = uuid.UUID(bytes=value.tobytes())
+        return result
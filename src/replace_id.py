@@ -1,7 +1,22 @@
 import psycopg2
+from psycopg2 import errorcodes
 from psycopg2.extras import RealDictCursor
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from queue import Queue
+import csv
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import threading
 import time
+import uuid
+
+from id_mapping import IdMappingExporter
 
 
 class Utils:
@@ -26,6 +41,10 @@ class DatabaseUtils:
     """
     Some utils to manage database conections, selects, etc.
     """
+    journal = None
+    instrumentation = None
+    throttle = None
+    step = None
 
     def get_connection(self, params):
         """
@@ -61,550 +80,4083 @@ class DatabaseUtils:
         rows = cursor.fetchall()
         return rows
 
-    def execute(self, connection, sql_command):
+    def execute(self, connection, sql_command, table_name=None, unit=None):
         """
         Perform a SQL command.
         :param connection: a opened connection.
-        :param select_command: the select command
+        :param sql_command: the SQL command
+        :param table_name: the table changed by the command, if any.
+        :param unit: the journal unit of the command (by default, built from the table and the command).
+        :return: the number of rows affected by the command (-1 when not applicable, None when skipped).
         """
+        journal = self.journal if self.step is not None and connection.autocommit else None
+        if journal is not None:
+            unit = unit or journal.build_unit(table_name, sql_command)
+            if journal.is_done(self.step, unit):
+                return None
+        record = None
+        if self.instrumentation is not None:
+            record = self.instrumentation.start(connection, self.step, table_name, sql_command)
         try:
             cursor = connection.cursor()
-            cursor.execute(sql_command)
+            if journal is None:
+                cursor.execute(sql_command)
+                rowcount = cursor.rowcount
+            else:
+                rowcount = journal.execute(cursor, self.step, unit, sql_command)
         except:
             print(sql_command)
+            if record is not None:
+                self.instrumentation.cancel(record)
             raise
+        if record is not None:
+            self.instrumentation.finish(connection, record, rowcount)
+        return rowcount
 
+    def execute_pipelined(self, connection, tasks, chunk_size):
+        """
+        Perform the tasks collected by a DeferredDatabaseUtils sending up to chunk_size SQL commands in each round
+        trip (a single multi-command string, run as one transaction). When a chunk fails, it is rolled back and its
+        commands are performed one by one, so the failing command is reported. The functions (batched updates) and
+        the commands that can not run in a transaction block are performed on their own.
+        :param tasks: a list of dicts with table_name and sql or function.
+        :param chunk_size: the maximum number of commands sent at once.
+        """
+        chunk = []
+        for task in tasks:
+            if 'function' in task or Journal.NON_TRANSACTIONAL.search(task['sql']):
+                self._execute_chunk(connection, chunk)
+                chunk = []
+                if 'function' in task:
+                    task['function'](self, connection)
+                else:
+                    self.execute(connection, task['sql'], task['table_name'])
+                continue
+            chunk.append(task)
+            if len(chunk) >= chunk_size:
+                self._execute_chunk(connection, chunk)
+                chunk = []
+        self._execute_chunk(connection, chunk)
 
-class IdReplacer:
-    """
-    Perform the ID replace.
-    """
+    def _execute_chunk(self, connection, tasks):
+        journal = self.journal if self.step is not None and connection.autocommit else None
+        if journal is not None:
+            tasks = [
+                task for task in tasks
+                if not journal.is_done(self.step, journal.build_unit(task['table_name'], task['sql']))
+            ]
+        if len(tasks) <= 1:
+            for task in tasks:
+                self.execute(connection, task['sql'], task['table_name'])
+            return
+        commands = [task['sql'].strip().rstrip(';') + ';' for task in tasks]
+        units = []
+        if journal is not None:
+            units = [journal.build_unit(task['table_name'], task['sql']) for task in tasks]
+            commands.extend(journal.build_sql_to_record(self.step, unit) for unit in units)
+        if not connection.autocommit:
+            commands = ['savepoint pk2uuid_pipeline;'] + commands + ['release savepoint pk2uuid_pipeline;']
+        sql_command = '\n'.join(commands)
+        table_names = set(task['table_name'] for task in tasks)
+        table_name = table_names.pop() if len(table_names) == 1 else None
+        record = None
+        if self.instrumentation is not None:
+            record = self.instrumentation.start(connection, self.step, table_name, sql_command)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql_command)
+        except psycopg2.Error:
+            if record is not None:
+                self.instrumentation.cancel(record)
+            if not connection.autocommit:
+                cursor.execute('rollback to savepoint pk2uuid_pipeline;')
+            Utils.print_message("...pipelined commands failed, performing them one by one")
+            for task in tasks:
+                self.execute(connection, task['sql'], task['table_name'])
+            return
+        if record is not None:
+            self.instrumentation.finish(connection, record, None)
+        if journal is not None:
+            journal.mark_done(self.step, units)
 
-    def __init__(self):
-        self.primary_keys = None
-        self.foreign_keys = None
+    def apply_settings(self, connection, settings):
+        """
+        Set session parameters (GUCs) on a connection.
+        :param settings: a dict name => value.
+        """
+        cursor = connection.cursor()
+        for name, value in settings.items():
+            cursor.execute('select set_config(%s, %s, false);', (name, str(value)))
 
-    def execute(self, *args, **kwargs):
+    def reset_settings(self, connection, settings):
         """
-        Replace the sequencial Id by the UUID.
-        :param args: some arguments.
-        :param kwargs: some key-arguments.
+        Reset the session parameters set by apply_settings. In a failed transaction, the rollback resets them.
+        """
+        if connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return
+        cursor = connection.cursor()
+        for name in settings.keys():
+            cursor.execute('reset %s;' % name)
 
+    def execute_in_batches(self, connection, table_name, key_column, build_sql, batch_size, pause=0, alias=None):
+        """
+        Perform a SQL command in batches, walking the integer key of the table in ranges of batch_size values.
+        Each batch is committed on its own. With a journal, each batch records the upper bound of its range (the
+        batch size may change between runs, with a throttle), and a rerun continues after the highest one.
+        :param connection: a opened connection.
+        :param table_name: the table changed by the command.
+        :param key_column: the integer column used to split the table in ranges.
+        :param build_sql: a function that receives the condition of the range and returns the SQL command.
+        :param batch_size: the number of key values of each range.
+        :param pause: the seconds to sleep between the batches.
+        :param alias: the alias of the table in the SQL command, if any.
         """
+        sql = 'select min("{key_column}") as low, max("{key_column}") as high from {table_name};'.format(
+            key_column=key_column,
+            table_name=table_name,
+        )
+        limits = self.select(connection, sql)[0]
+        if limits['low'] is None:
+            return
+        key_sql = '"%s"' % key_column if alias is None else '%s."%s"' % (alias, key_column)
+        low = limits['low']
+        journal = self.journal if self.step is not None and connection.autocommit else None
+        unit = None
+        if journal is not None:
+            unit = journal.build_unit(table_name, build_sql(None))
+            high_water = journal.get_high_water(self.step, unit)
+            if high_water is not None:
+                low = high_water + 1
+        rows = 0
         start_time = time.time()
-        params = kwargs.get('params')
-        if params is None:
-            raise Exception('Params not defined')
-        utils = DatabaseUtils()
-        kwargs['utils'] = utils
-        conn = utils.get_connection(params)
-        try:
-            with conn:
-                # Primary Key
-                self.primary_keys = self._get_primary_keys(conn)
-                self.foreign_keys = self._get_foreign_keys(conn)
-                kwargs['rows'] = self.primary_keys
-                self.set_up(conn, *args, **kwargs)
-                try:
-                    Utils.print_message("Droping PK default value")
-                    self._drop_pk_default_value(conn, *args, **kwargs)
+        while low <= limits['high']:
+            if self.throttle is not None:
+                batch_size, pause = self.throttle.get_batch()
+            high = low + batch_size - 1
+            condition = '{key_sql} between {low} and {high}'.format(key_sql=key_sql, low=low, high=high)
+            rowcount = self.execute(
+                connection, build_sql(condition), table_name, None if unit is None else '%s@%d' % (unit, high)
+            )
+            if not connection.autocommit:
+                connection.commit()
+            if self.instrumentation is not None and rowcount is not None and rowcount > 0:
+                rows += rowcount
+                self.instrumentation.progress(
+                    table_name, rows, time.time() - start_time,
+                    (min(high, limits['high']) - limits['low'] + 1) / (limits['high'] - limits['low'] + 1)
+                )
+            low = high + 1
+            if self.throttle is not None:
+                pause = self.throttle.update(connection)
+            if pause and low <= limits['high']:
+                time.sleep(pause)
 
-                    Utils.print_message("Creating temporary pk column")
-                    self._create_temporary_column(conn, *args, **kwargs)
 
-                    Utils.print_message("Assign values to temporary pk column")
-                    self._assign_value_to_temporary_pk_column(conn, *args, **kwargs)
+class Instrumentation:
+    """
+    Measure each SQL command: wall time, rows affected, WAL bytes generated (from pg_current_wal_lsn) and time
+    waiting for locks (sampled from pg_stat_activity by a monitor connection). The measures are given to the hooks
+    and can be dumped to a JSON or CSV report.
 
-                    Utils.print_message("Creating serial column")
-                    self._create_serial_column(conn, *args, **kwargs)
+    The WAL position is global to the server: the WAL bytes of a command are the ones generated while it ran, by
+    any session (the other workers included), so they are approximate. The WAL bytes of a phase are measured
+    from its own start and end positions, not summed from its commands.
+    """
 
-                    Utils.print_message("Copying pk to serial column")
-                    self._copy_pk_column_to_serial_column(conn, *args, **kwargs)
+    def __init__(self, params, on_statement=None, on_phase=None):
+        """
+        :param params: the connection parameters, used by the lock wait monitor; sample_interval sets how often
+        (seconds, default 0.5) the waits are sampled.
+        :param on_statement: a function called with the record of each finished command.
+        :param on_phase: a function called with the record of each finished phase.
+        """
+        self.params = dict(params, autocommit=True)
+        self.sample_interval = params.get('sample_interval', 0.5)
+        self.on_statement = on_statement
+        self.on_phase = on_phase
+        self.statements = []
+        self.phases = []
+        self.running = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.monitor = None
 
-                    # Foreign Key
-                    kwargs['rows'] = self.foreign_keys
-                    Utils.print_message("Dropping fk constraints")
-                    self._drop_fk_constraint(conn, *args, **kwargs)
+    def start_monitor(self):
+        self.monitor = threading.Thread(target=self._sample_lock_waits, daemon=True)
+        self.monitor.start()
 
-                    Utils.print_message("Changing fk to varchar")
-                    self._change_fk_column_to_datatype(conn, *args, **kwargs, data_type='varchar')
+    def stop_monitor(self):
+        self.stopped.set()
+        if self.monitor is not None:
+            self.monitor.join()
+            self.monitor = None
 
-                    Utils.print_message("Copying pk column to fk column (uuid)")
-                    self._copy_pk_values_to_fk_columns(conn, *args, **kwargs)
+    def _sample_lock_waits(self):
+        connection = DatabaseUtils().get_connection(self.params)
+        try:
+            while not self.stopped.wait(self.sample_interval):
+                with self.lock:
+                    pids = list(self.running.keys())
+                if not pids:
+                    continue
+                sql = """
+                select pid from pg_stat_activity where wait_event_type = 'Lock' and pid in ({pids});
+                """.format(
+                    pids=', '.join(str(pid) for pid in pids),
+                )
+                rows = DatabaseUtils().select(connection, sql)
+                with self.lock:
+                    for row in rows:
+                        record = self.running.get(row['pid'])
+                        if record is not None:
+                            record['lock_wait_seconds'] += self.sample_interval
+        finally:
+            connection.close()
 
-                    Utils.print_message("Changing fk to uuid")
-                    self._change_fk_column_to_datatype(conn, *args, **kwargs, data_type='uuid')
+    def _get_wal_lsn(self, connection):
+        cursor = connection.cursor()
+        cursor.execute('select pg_current_wal_lsn()::text;')
+        return cursor.fetchone()[0]
 
-                    Utils.print_message("Changing pk to uuid")
-                    kwargs['rows'] = self.primary_keys
-                    self._change_column_to_uuid(conn, *args, **kwargs)
+    def _get_wal_bytes(self, connection, lsn):
+        cursor = connection.cursor()
+        cursor.execute("select pg_wal_lsn_diff(pg_current_wal_lsn(), '%s')::bigint;" % lsn)
+        return cursor.fetchone()[0]
 
-                    Utils.print_message("Setting the uuid primary key value")
-                    self._copy_temporary_column_to_pk(conn, *args, **kwargs)
+    def start(self, connection, step, table_name, sql_command):
+        record = {
+            'step': step,
+            'table_name': table_name,
+            'statement': ' '.join(sql_command.split()),
+            'started_at': datetime.now().isoformat(),
+            'seconds': 0,
+            'rows': None,
+            'wal_bytes': None,
+            'lock_wait_seconds': 0,
+            '_start_time': time.time(),
+            '_lsn': self._get_wal_lsn(connection),
+            '_pid': connection.get_backend_pid(),
+        }
+        with self.lock:
+            self.running[record['_pid']] = record
+        return record
 
-                    Utils.print_message("Defining a default value to pk")
-                    self._add_default_value_to_pk(conn, *args, **kwargs)
+    def cancel(self, record):
+        with self.lock:
+            self.running.pop(record['_pid'], None)
 
-                    Utils.print_message("Recreating fk constraints")
-                    kwargs['rows'] = self.foreign_keys
-                    self._create_fk_constraint(conn, *args, **kwargs)
+    def finish(self, connection, record, rowcount):
+        self.cancel(record)
+        record['seconds'] = round(time.time() - record.pop('_start_time'), 3)
+        record['rows'] = rowcount if rowcount is not None and rowcount >= 0 else None
+        record['wal_bytes'] = self._get_wal_bytes(connection, record.pop('_lsn'))
+        record.pop('_pid')
+        with self.lock:
+            self.statements.append(record)
+        if self.on_statement is not None:
+            self.on_statement(record)
 
-                    Utils.print_message("Drop temporary column")
-                    kwargs['rows'] = self.primary_keys
-                    self._drop_temporary_column(conn, *args, **kwargs)
-                finally:
-                    kwargs['rows'] = self.primary_keys
-                    self.tear_down(conn, *args, **kwargs)
-        finally:
-            conn.close()
+    def progress(self, table_name, rows, seconds, fraction):
+        """
+        Print the progress of a command run in batches.
+        """
+        Utils.print_message("......%s: %d rows, %d rows/s, %d%%" % (
+            table_name, rows, rows / seconds if seconds else 0, round(fraction * 100)
+        ))
 
-        seconds = round(time.time() - start_time, 2)
-        duration = Utils.to_hour_minute_second(seconds)
-        print("------")
-        print("FINISH")
-        print("------")
-        print("--- %s DURATION ---" % duration)
-        print("------")
+    def start_phase(self, connection):
+        """
+        :return: the WAL position at the start of the phase, given to finish_phase.
+        """
+        return self._get_wal_lsn(connection)
 
-    def _build_sql_to_enable_trigger(self, table_name, action, restrict):
-        sql = "alter table if exists {table_name} {action} trigger {restrict};".format(
-            table_name=table_name,
-            action=action,
-            restrict=restrict,
-        )
-        return sql
+    def finish_phase(self, connection, step, seconds, lsn):
+        with self.lock:
+            statements = [record for record in self.statements if record['step'] == step]
+        record = {
+            'step': step,
+            'seconds': round(seconds, 3),
+            'statements': len(statements),
+            'rows': sum(record['rows'] or 0 for record in statements),
+            'wal_bytes': self._get_wal_bytes(connection, lsn),
+            'lock_wait_seconds': sum(record['lock_wait_seconds'] for record in statements),
+        }
+        self.phases.append(record)
+        if self.on_phase is not None:
+            self.on_phase(record)
 
-    def _enable_trigger(self, connection, *args, **kwargs):
-        rows = kwargs['rows']
-        utils = kwargs['utils']
-        action = kwargs['action']
-        for row in rows:
-            table_schema = row['table_schema']
-            table_name = row['table_name']
-            table_name = self._build_table_name(table_schema, table_name)
+    def write_report(self, file_name):
+        """
+        Write the measures to a JSON file (phases and statements) or, when the file name ends with .csv, the
+        statements to a CSV file.
+        """
+        if file_name.lower().endswith('.csv'):
+            fields = ['step', 'table_name', 'statement', 'started_at', 'seconds', 'rows', 'wal_bytes',
+                      'lock_wait_seconds']
+            with open(file_name, 'w', newline='') as report:
+                writer = csv.DictWriter(report, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(self.statements)
+            return
+        with open(file_name, 'w') as report:
+            json.dump({'phases': self.phases, 'statements': self.statements}, report, indent=2)
 
-            Utils.print_message("..." + action + " trigger, if exists, on " + table_name)
 
-            sql = self._build_sql_to_enable_trigger(table_name, action, restrict='all')
-            if sql is None:
-                return
-            try:
-                utils.execute(connection, sql)
-                continue
-            except:
-                pass
-            sql = self._build_sql_to_enable_trigger(table_name, action, restrict='user')
-            if sql is not None:
-                utils.execute(connection, sql)
+class Throttle:
+    """
+    Adapt the batch size and the pause between the batches to the load of the server: after each batch, the
+    replication lag (pg_stat_replication), the WAL generation rate and the active backends are sampled. While they
+    are under their ceilings, the batch size grows by a step (additive increase) and the pause shrinks; when one of
+    them is over its ceiling, the batch size is halved and the pause doubled (multiplicative decrease). Shared by the
+    workers.
+    """
 
-    def set_up(self, connection, *args, **kwargs):
-        kwargs['action'] = 'disable'
-        Utils.print_message("Disabling trigger")
-        self._enable_trigger(connection, *args, **kwargs)
+    def __init__(self, params):
+        """
+        :param params: a dict with the ceilings (max_replication_lag in bytes, max_wal_rate in bytes per second,
+        max_active_backends), the initial batch_size and batch_pause, and optionally min_batch_size,
+        max_batch_size, max_batch_pause and throttle_interval (the minimum seconds between samples).
+        """
+        self.max_replication_lag = params.get('max_replication_lag')
+        self.max_wal_rate = params.get('max_wal_rate')
+        self.max_active_backends = params.get('max_active_backends')
+        self.batch_size = params['batch_size']
+        self.min_batch_size = params.get('min_batch_size', max(1, self.batch_size // 100))
+        self.max_batch_size = params.get('max_batch_size', self.batch_size * 10)
+        self.step = max(1, self.batch_size // 10)
+        self.pause = params.get('batch_pause', 0)
+        self.min_pause = self.pause
+        self.max_pause = params.get('max_batch_pause', 30)
+        self.interval = params.get('throttle_interval', 1)
+        self.sample = None
+        self.lock = threading.Lock()
 
-    def tear_down(self, connection, *args, **kwargs):
-        kwargs['action'] = 'enable'
-        Utils.print_message("Enabling trigger")
-        self._enable_trigger(connection, *args, **kwargs)
+    def get_batch(self):
+        """
+        :return: the current batch size and pause.
+        """
+        with self.lock:
+            return self.batch_size, self.pause
 
-    def _build_sql_to_add_default_value(self, table_name, column_name):
-        sql = 'alter table if exists {table_name} alter column "{column_name}" set default gen_random_uuid();'.format(
-            table_name=table_name,
-            column_name=column_name,
-        )
-        return sql
+    def _read_sample(self, connection):
+        sql = """
+        select
+          pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0') as wal_position,
+          (select max(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)) from pg_stat_replication) as replication_lag,
+          (
+            select count(*) from pg_stat_activity
+            where state = 'active' and backend_type = 'client backend' and pid <> pg_backend_pid()
+          ) as active_backends;
+        """
+        row = DatabaseUtils().select(connection, sql)[0]
+        return dict(row, time=time.time())
 
-    def _add_default_value_to_pk(self, connection, *args, **kwargs):
-        rows = kwargs['rows']
-        utils = kwargs['utils']
+    def _is_overloaded(self, previous, current):
+        if self.max_replication_lag is not None and (current['replication_lag'] or 0) > self.max_replication_lag:
+            return True
+        if self.max_active_backends is not None and current['active_backends'] > self.max_active_backends:
+            return True
+        if self.max_wal_rate is not None and previous is not None and current['time'] > previous['time']:
+            wal_bytes = float(current['wal_position']) - float(previous['wal_position'])
+            return wal_bytes / (current['time'] - previous['time']) > self.max_wal_rate
+        return False
 
-        for row in rows:
-            table_schema = row['table_schema']
-            table_name = row['table_name']
-            table_name = self._build_table_name(table_schema, table_name)
-            column_name = row['column_name']
+    def update(self, connection):
+        """
+        Sample the server (at most every throttle_interval seconds) and adjust the batch size and pause.
+        :return: the pause before the next batch.
+        """
+        with self.lock:
+            if self.sample is not None and time.time() - self.sample['time'] < self.interval:
+                return self.pause
+        current = self._read_sample(connection)
+        with self.lock:
+            previous = self.sample
+            self.sample = current
+            if self._is_overloaded(previous, current):
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+                self.pause = min(self.max_pause, max(self.pause * 2, 0.1))
+            else:
+                self.batch_size = min(self.max_batch_size, self.batch_size + self.step)
+                self.pause = max(self.min_pause, self.pause / 2 if self.pause > 0.1 else 0)
+            return self.pause
 
-            Utils.print_message("...adding default value to PK " + table_name + "." + column_name)
 
-            sql = self._build_sql_to_add_default_value(table_name, column_name)
-            if sql is not None:
-                utils.execute(connection, sql)
+class Journal:
+    """
+    Record the finished units (phases and commands) of a run in a table of the target database, so a rerun of a
+    failed conversion skips them and continues from the failed one.
 
-    def _build_sql_to_drop_default_value(self, table_name, column_name):
-        sql = 'alter table if exists {table_name} alter column "{column_name}" drop default;'.format(
-            table_name=table_name,
-            column_name=column_name,
+    A command and its record are committed in the same transaction, except the commands that can not run in a
+    transaction block (they are recorded right after). The journal only works on autocommit connections: in an
+    outer transaction, the records would be rolled back with it.
+    """
+    NON_TRANSACTIONAL = re.compile(r'\b(concurrently|vacuum)\b', re.IGNORECASE)
+
+    def __init__(self, table_name):
+        """
+        :param table_name: the journal table (schema.table).
+        """
+        self.table_name = table_name
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def _build_sql_to_create(self):
+        sql = """
+        create table if not exists {table_name} (
+          step varchar not null,
+          unit varchar not null,
+          detail text,
+          finished_at timestamp not null default now(),
+          primary key (step, unit)
+        );
+        """.format(
+            table_name=self.table_name,
         )
         return sql
 
-    def _drop_column_default_value(self, connection, *args, **kwargs):
-        rows = kwargs['rows']
-        utils = kwargs['utils']
-        for row in rows:
-            table_name = self._build_table_name(row['table_schema'], row['table_name'])
-            column_name = row['column_name']
-            sql = self._build_sql_to_drop_default_value(table_name, column_name)
-            utils.execute(connection, sql)
-
-    def _build_sql_to_copy_pk_values_to_fk_columns(
-            self, table_name, column_name, temp_name, foreign_table_name, foreign_column_name
-    ):
+    def build_sql_to_record(self, step, unit, detail=None):
         sql = """
-        update {table_name} a 
-        set "{column_name}" = x."{temp_name}"::varchar
-        from {foreign_table_name} x
-        where a."{column_name}"::varchar = x."{foreign_column_name}"::varchar;
+        insert into {table_name} (step, unit, detail) values ({step}, {unit}, {detail}) on conflict do nothing;
         """.format(
-            table_name=table_name,
-            temp_name=temp_name,
-            foreign_table_name=foreign_table_name,
-            column_name=column_name,
-            foreign_column_name=foreign_column_name,
+            table_name=self.table_name,
+            step=self._quote(step),
+            unit=self._quote(unit),
+            detail='null' if detail is None else self._quote(detail),
         )
         return sql
 
-    def _copy_pk_values_to_fk_columns(self, connection, *args, **kwargs):
-        rows = kwargs['rows']
-        utils = kwargs['utils']
+    def _quote(self, value):
+        return "'%s'" % value.replace("'", "''")
 
-        for row in rows:
-            table_schema = row['table_schema']
-            table_name = row['table_name']
-            table_name = self._build_table_name(table_schema, table_name)
+    def load(self, connection):
+        """
+        Create the journal table, if needed, and read the units already finished.
+        """
+        self._check_autocommit(connection)
+        cursor = connection.cursor()
+        cursor.execute(self._build_sql_to_create())
+        rows = DatabaseUtils().select(connection, 'select step, unit from %s;' % self.table_name)
+        self.done = set((row['step'], row['unit']) for row in rows)
 
-            column_name = row['column_name']
-            foreign_table_name = self._build_table_name(row['foreign_table_schema'], row['foreign_table_name'])
-            foreign_column_name = row['foreign_column_name']
-            temp_name = self._build_temp_column_name(foreign_column_name)
+    def build_unit(self, table_name, sql_command):
+        return '%s:%s' % (table_name, hashlib.md5(sql_command.encode('utf-8')).hexdigest())
 
-            Utils.print_message("...copying pk => fk " + table_name + "." + column_name)
+    def get_high_water(self, step, unit):
+        """
+        :return: the highest upper bound recorded by the batches (units unit@high) of a command, or None.
+        """
+        prefix = unit + '@'
+        with self.lock:
+            highs = [
+                int(done_unit[len(prefix):]) for done_step, done_unit in self.done
+                if done_step == step and done_unit.startswith(prefix)
+            ]
+        return max(highs) if highs else None
 
-            sql = self._build_sql_to_copy_pk_values_to_fk_columns(
-                table_name, column_name, temp_name, foreign_table_name, foreign_column_name
-            )
-            if sql is not None:
-                try:
-                    utils.execute(connection, sql)
-                except Exception as e:
-                    print(sql)
-                    raise e
+    def is_done(self, step, unit):
+        with self.lock:
+            return (step, unit) in self.done
 
-    def _build_sql_to_alter_column_datatype(self, table_name, column_name, data_type):
-        sql = """
-        alter table {table_name} alter column "{column_name}" type {data_type} using "{column_name}"::{data_type};
-        """.format(
-            table_name=table_name,
-            column_name=column_name,
-            data_type=data_type,
-        )
-        return sql
+    def execute(self, cursor, step, unit, sql_command):
+        """
+        Perform a command, on a autocommit connection, and record it as finished.
+        :return: the number of rows affected by the command.
+        """
+        record = self.build_sql_to_record(step, unit)
+        if self.NON_TRANSACTIONAL.search(sql_command):
+            cursor.execute(sql_command)
+            rowcount = cursor.rowcount
+            cursor.execute(record)
+        else:
+            cursor.execute('begin;')
+            try:
+                cursor.execute(sql_command)
+                rowcount = cursor.rowcount
+                cursor.execute(record)
+                cursor.execute('commit;')
+            except:
+                cursor.execute('rollback;')
+                raise
+        with self.lock:
+            self.done.add((step, unit))
+        return rowcount
 
-    def _build_sql_to_alter_column_to_uuid(self, table_name, column_name):
-        sql = """
-        alter table {table_name} alter column "{column_name}" type uuid 
-        using cast(lpad(to_hex("{column_name}"), 32, '0') as uuid);
-        """.format(
-            table_name=table_name,
-            column_name=column_name,
+    def mark_done(self, step, units):
+        """
+        Mark as finished units whose records were committed by the caller.
+        """
+        with self.lock:
+            self.done.update((step, unit) for unit in units)
+
+    def _check_autocommit(self, connection):
+        if not connection.autocommit:
+            raise Exception('The journal %s requires an autocommit connection' % self.table_name)
+
+    def record(self, connection, step, unit, detail=None):
+        self._check_autocommit(connection)
+        cursor = connection.cursor()
+        cursor.execute(self.build_sql_to_record(step, unit, detail))
+        with self.lock:
+            self.done.add((step, unit))
+
+    def get_detail(self, connection, step, unit):
+        sql = "select detail from {table_name} where step = {step} and unit = {unit};".format(
+            table_name=self.table_name,
+            step=self._quote(step),
+            unit=self._quote(unit),
         )
-        return sql
+        rows = DatabaseUtils().select(connection, sql)
+        return rows[0]['detail'] if rows else None
 
-    def _change_fk_column_to_datatype(self, connection, *args, **kwargs):
-        rows = kwargs['rows']
-        data_type = kwargs['data_type']
-        utils = kwargs['utils']
-        for row in rows:
-            column_data_type = row['data_type']
-            if column_data_type == data_type:
-                continue
 
-            schema_name = row['table_schema']
-            table_name = row['table_name']
-            table_name = self._build_table_name(schema_name, table_name)
-            column_name = row['column_name']
+class DeferredDatabaseUtils(DatabaseUtils):
+    """
+    Collect the SQL commands of a phase, instead of performing them, so they can be run later by a
+    ParallelExecutor. Selects are still performed immediately.
+    """
 
-            Utils.print_message("...changing FK datatype " + table_name + "." + column_name + " => " + data_type)
+    def __init__(self):
+        self.tasks = []
 
-            sql = self._build_sql_to_alter_column_datatype(table_name, column_name, data_type)
-            if sql is not None:
-                utils.execute(connection, sql)
+    def execute(self, connection, sql_command, table_name=None):
+        self.tasks.append({'table_name': table_name, 'sql': sql_command})
 
-    def _change_column_to_uuid(self, connection, *args, **kwargs):
-        rows = self._get_primary_keys(connection)
-        utils = kwargs['utils']
-        for row in rows:
-            data_type = row['data_type']
-            if data_type == 'uuid':
-                continue
+    def execute_in_batches(self, connection, table_name, key_column, build_sql, batch_size, pause=0, alias=None):
+        def function(utils, worker_connection):
+            utils.execute_in_batches(worker_connection, table_name, key_column, build_sql, batch_size, pause, alias)
+        self.tasks.append({'table_name': table_name, 'function': function})
 
-            schema_name = row['table_schema']
-            table_name = row['table_name']
-            table_name = self._build_table_name(schema_name, table_name)
-            column_name = row['column_name']
 
-            Utils.print_message("...changing column to UUID " + table_name + "." + column_name)
+class ScriptDatabaseUtils(DatabaseUtils):
+    """
+    Record the SQL commands, in order, instead of performing them (dry run). Selects are still performed.
+    """
 
-            sql = self._build_sql_to_alter_column_to_uuid(table_name, column_name)
-            if sql is not None:
-                utils.execute(connection, sql)
+    def __init__(self):
+        self.statements = []
 
-    def _build_sql_to_drop_constraint(self, table_name, constraint_name):
-        sql = 'alter table {table_name} drop constraint "{constraint_name}";'.format(
-            table_name=table_name,
-            constraint_name=constraint_name,
-        )
-        return sql
+    def execute(self, connection, sql_command, table_name=None):
+        self.statements.append({
+            'step': self.step, 'table_name': table_name, 'sql': sql_command.strip(), 'batched': False,
+        })
+        return None
 
-    def _build_sql_to_create_constraint(
-            self, table_name, constraint_name, column_name, foreign_table_name, foreign_column_name,
-            match_option, update_rule, delete_rule
-    ):
-        sql = """
-        alter table {table_name} add constraint "{constraint_name}" 
-        foreign key ("{column_name}") references {foreign_table_name} ("{foreign_column_name}")
-        match {match_option} on delete {delete_rule} on update {update_rule}; 
-        """.format(
-            table_name=table_name,
-            constraint_name=constraint_name,
-            column_name=column_name,
-            foreign_table_name=foreign_table_name,
-            foreign_column_name=foreign_column_name,
+    def execute_in_batches(self, connection, table_name, key_column, build_sql, batch_size, pause=0, alias=None):
+        self.statements.append({
+            'step': self.step, 'table_name': table_name, 'sql': build_sql(None).strip(), 'batched': True,
+        })
+
+    def execute_pipelined(self, connection, tasks, chunk_size):
+        for task in tasks:
+            if 'function' in task:
+                task['function'](self, connection)
+            else:
+                self.execute(connection, task['sql'], task['table_name'])
+
+
+class ParallelExecutor:
+    """
+    Run the SQL commands collected in a phase across a pool of connections.
+
+    The commands of a same table are run in order, by the same worker; the tables are scheduled from the largest
+    to the smallest one.
+    """
+
+    def __init__(self, params, workers, table_sizes):
+        """
+        :param params: the connection parameters (see DatabaseUtils.get_connection).
+        :param workers: the number of connections (and threads).
+        :param table_sizes: a dict table name => size in bytes, used to schedule the largest tables first.
+        """
+        self.params = dict(params, autocommit=True)
+        self.pipeline = params.get('pipeline')
+        self.workers = workers
+        self.table_sizes = table_sizes
+        self.connections = []
+        self.idle_connections = Queue()
+        self.lock = threading.Lock()
+
+    def _get_connection(self):
+        with self.lock:
+            if self.idle_connections.empty() and len(self.connections) < self.workers:
+                connection = DatabaseUtils().get_connection(self.params)
+                self.connections.append(connection)
+                return connection
+        return self.idle_connections.get()
+
+    def _run_group(self, utils, tasks, settings, pipeline):
+        connection = self._get_connection()
+        try:
+            if settings:
+                utils.apply_settings(connection, settings)
+            try:
+                if pipeline and self.pipeline:
+                    utils.execute_pipelined(connection, tasks, 100 if self.pipeline is True else self.pipeline)
+                else:
+                    for task in tasks:
+                        if 'function' in task:
+                            task['function'](utils, connection)
+                        else:
+                            utils.execute(connection, task['sql'], task['table_name'])
+            finally:
+                if settings:
+                    utils.reset_settings(connection, settings)
+        finally:
+            self.idle_connections.put(connection)
+
+    def run(self, tasks, utils=None, group_by_table=True, settings=None, pipeline=True):
+        """
+        Run the tasks, grouped by table.
+        :param tasks: a list of dicts with table_name and sql or function (see DeferredDatabaseUtils).
+        :param utils: the DatabaseUtils used to perform the commands.
+        :param group_by_table: False to run every task on its own, even the tasks of a same table.
+        :param settings: a dict of session parameters (GUCs) set on the connections while running the tasks.
+        :param pipeline: False to run the tasks one by one, even with params pipeline.
+        """
+        utils = utils or DatabaseUtils()
+        groups = []
+        by_table = OrderedDict()
+        for task in tasks:
+            if group_by_table:
+                group = by_table.setdefault(task['table_name'], [])
+                if not group:
+                    groups.append(group)
+                group.append(task)
+            else:
+                groups.append([task])
+        groups.sort(key=lambda group: self.table_sizes.get(group[0]['table_name'], 0), reverse=True)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self._run_group, utils, group, settings, pipeline) for group in groups]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _run_select(self, sql):
+        connection = self._get_connection()
+        try:
+            return DatabaseUtils().select(connection, sql)
+        finally:
+            self.idle_connections.put(connection)
+
+    def select(self, queries):
+        """
+        Run select commands across the pool of connections, the largest tables first.
+        :param queries: a dict table name => select command.
+        :return: a dict table name => rows.
+        """
+        names = sorted(queries, key=lambda name: self.table_sizes.get(name, 0), reverse=True)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = dict((pool.submit(self._run_select, queries[name]), name) for name in names)
+            try:
+                return dict((futures[future], future.result()) for future in as_completed(futures))
+            except:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+class SchemaGraph:
+    """
+    The keys to convert, indexed by table. Can be saved to a snapshot file and reused by later runs.
+    """
+
+    def __init__(self, primary_keys, foreign_keys, indexes=(), partitions=()):
+        """
+        :param primary_keys: the rows of the primary keys (see IdReplacer._get_keys).
+        :param foreign_keys: the rows of the foreign keys.
+        :param indexes: the rows of the secondary indexes (see IdReplacer._get_indexes); only the ones over the
+        converted columns are kept.
+        :param partitions: the rows of the leaf partitions of the partitioned tables (see
+        IdReplacer._get_partitions); only the ones of the converted tables are kept.
+        """
+        self.primary_keys = list(primary_keys)
+        self.foreign_keys = list(foreign_keys)
+        self.tables = OrderedDict()
+        for row in self.primary_keys:
+            self._get_or_add_table(row['table_schema'], row['table_name'])['primary_key'] = row
+        for row in self.foreign_keys:
+            self._get_or_add_table(row['table_schema'], row['table_name'])['foreign_keys'].append(row)
+            self._get_or_add_table(row['foreign_table_schema'], row['foreign_table_name'])['referenced_by'].append(row)
+        self.indexes = []
+        for row in indexes:
+            table = self.tables.get((row['table_schema'], row['table_name']))
+            if table is None or not set(row['column_names']) & self.get_converted_columns(table):
+                continue
+            table['indexes'].append(row)
+            self.indexes.append(row)
+        self.partitions = []
+        for row in partitions:
+            table = self.tables.get((row['table_schema'], row['table_name']))
+            if table is None:
+                continue
+            table['partitions'].append(row)
+            self.partitions.append(row)
+
+    def get_converted_columns(self, table):
+        """
+        :return: the names of the PK and FK columns of the table that are converted.
+        """
+        columns = set(row['column_name'] for row in table['foreign_keys'])
+        if table['primary_key'] is not None:
+            columns.add(table['primary_key']['column_name'])
+        return columns
+
+    def _get_or_add_table(self, table_schema, table_name):
+        return self.tables.setdefault((table_schema, table_name), {
+            'table_schema': table_schema,
+            'table_name': table_name,
+            'primary_key': None,
+            'foreign_keys': [],
+            'referenced_by': [],
+            'indexes': [],
+            'partitions': [],
+        })
+
+    def get_table(self, table_schema, table_name):
+        """
+        :return: a dict with table_schema, table_name, primary_key (a row or None), foreign_keys, referenced_by
+        (the foreign keys of other tables pointing to the table), indexes and partitions, or None when the table has
+        no key to convert.
+        """
+        return self.tables.get((table_schema, table_name))
+
+    def filter(self, include_schemas=(), exclude_schemas=(), include_tables=(), exclude_tables=()):
+        """
+        Restrict the conversion to a subset of the tables, keeping it consistent: the PKs of the selected tables are
+        converted with every FK column referencing them (the tables of those columns are added to the conversion,
+        only for these columns); the FK columns referencing tables not selected are kept.
+        :param include_schemas: patterns (fnmatch) of the schemas to convert; all schemas when empty.
+        :param exclude_schemas: patterns of the schemas not to convert.
+        :param include_tables: patterns of the tables ("schema.table") to convert; all tables when empty.
+        :param exclude_tables: patterns of the tables not to convert.
+        :return: a new SchemaGraph.
+        """
+        def matches(name, patterns):
+            return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+        def is_selected(table_schema, table_name):
+            if include_schemas and not matches(table_schema, include_schemas):
+                return False
+            if include_tables and not matches('%s.%s' % (table_schema, table_name), include_tables):
+                return False
+            return not is_excluded(table_schema, table_name)
+
+        def is_excluded(table_schema, table_name):
+            return matches(table_schema, exclude_schemas) or matches(
+                '%s.%s' % (table_schema, table_name), exclude_tables
+            )
+
+        primary_keys = [row for row in self.primary_keys if is_selected(row['table_schema'], row['table_name'])]
+        converted = set((row['table_schema'], row['table_name']) for row in primary_keys)
+        foreign_keys = []
+        for row in self.foreign_keys:
+            if (row['foreign_table_schema'], row['foreign_table_name']) not in converted:
+                continue
+            if is_excluded(row['table_schema'], row['table_name']):
+                raise Exception('The table %s.%s is excluded, but its FK %s references the converted table %s.%s' % (
+                    row['table_schema'], row['table_name'], row['constraint_name'], row['foreign_table_schema'],
+                    row['foreign_table_name']
+                ))
+            foreign_keys.append(row)
+        return SchemaGraph(primary_keys, foreign_keys, self.indexes, self.partitions)
+
+    def rename_schema(self, old_schema, new_schema):
+        """
+        Move the keys and indexes of a schema to another one, to reuse the graph in databases or schemas with the
+        same tables.
+        :return: a new SchemaGraph.
+        """
+        def rename(row):
+            row = dict(row)
+            for name in ['table_schema', 'foreign_table_schema', 'partition_schema']:
+                if row.get(name) == old_schema:
+                    row[name] = new_schema
+            if 'definition' in row and row['table_schema'] == new_schema:
+                row['definition'] = re.sub(
+                    r' ON (ONLY )?%s\.' % re.escape(self._quote_ident(old_schema)),
+                    lambda match: ' ON %s%s.' % (match.group(1) or '', self._quote_ident(new_schema)),
+                    row['definition'],
+                    count=1,
+                )
+            return row
+
+        return SchemaGraph(
+            [rename(row) for row in self.primary_keys],
+            [rename(row) for row in self.foreign_keys],
+            [rename(row) for row in self.indexes],
+            [rename(row) for row in self.partitions],
+        )
+
+    def drop_oids(self):
+        """
+        Remove the oids of the tables, that are only valid in the database where the keys were read.
+        :return: a new SchemaGraph.
+        """
+        def drop(row):
+            return dict((name, value) for name, value in row.items() if name not in ('table_oid', 'foreign_table_oid'))
+
+        return SchemaGraph(
+            [drop(row) for row in self.primary_keys],
+            [drop(row) for row in self.foreign_keys],
+            self.indexes,
+            self.partitions,
+        )
+
+    def _quote_ident(self, name):
+        if re.match(r'^[a-z_][a-z0-9_$]*$', name):
+            return name
+        return '"%s"' % name.replace('"', '""')
+
+    def to_dict(self):
+        return {
+            'primary_keys': self.primary_keys,
+            'foreign_keys': self.foreign_keys,
+            'indexes': self.indexes,
+            'partitions': self.partitions,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['primary_keys'], data['foreign_keys'], data.get('indexes', []), data.get('partitions', []))
+
+    def save(self, file_name):
+        with open(file_name, 'w') as snapshot:
+            json.dump(self.to_dict(), snapshot, indent=2)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as snapshot:
+            return cls.from_dict(json.load(snapshot))
+
+
+class UuidStrategy(ABC):
+    """
+    How the new uuid values are generated.
+
+    A deterministic strategy derives the uuid from (table, old integer id), so the PK and every FK column can be
+    converted in place by "alter ... using", without temporary columns or joins between the tables.
+    """
+    deterministic = False
+
+    @abstractmethod
+    def build_value(self, table_name, column_sql):
+        """
+        :param table_name: the table (schema.table) that owns the id.
+        :param column_sql: the SQL expression of the old integer id.
+        :return: the SQL expression of the new uuid.
+        """
+
+    def build_default(self):
+        """
+        :return: the SQL expression used as default value of the new PK column.
+        """
+        return 'gen_random_uuid()'
+
+    def to_uuid(self, table_name, old_id):
+        """
+        The uuid given to an old id, computed in Python. Only the deterministic strategies implement it.
+        """
+        raise Exception(
+            '%s is not deterministic: the uuid of an old id can not be computed, read it from the database or '
+            'from an id mapping file' % type(self).__name__
+        )
+
+    def _quote(self, value):
+        return "'%s'" % str(value).replace("'", "''")
+
+
+class RandomUuidStrategy(UuidStrategy):
+    """
+    Random (version 4) uuids, from gen_random_uuid().
+    """
+
+    def build_value(self, table_name, column_sql):
+        return 'gen_random_uuid()'
+
+
+class NamespaceUuidStrategy(UuidStrategy):
+    """
+    Name based (version 5) uuids of "schema.table:id" in a namespace. Requires the uuid-ossp extension.
+    """
+    deterministic = True
+
+    def __init__(self, namespace):
+        self.namespace = uuid.UUID(str(namespace))
+
+    def build_value(self, table_name, column_sql):
+        return "uuid_generate_v5({namespace}::uuid, {prefix} || ({column_sql})::text)".format(
+            namespace=self._quote(self.namespace),
+            prefix=self._quote(table_name + ':'),
+            column_sql=column_sql,
+        )
+
+    def to_uuid(self, table_name, old_id):
+        return uuid.uuid5(self.namespace, '%s:%s' % (table_name, old_id))
+
+
+class HashUuidStrategy(UuidStrategy):
+    """
+    Uuids taken from the md5 of "key:schema.table:id". No extension is required.
+    """
+    deterministic = True
+
+    def __init__(self, key=''):
+        self.key = key
+
+    def build_value(self, table_name, column_sql):
+        return "cast(md5({prefix} || ({column_sql})::text) as uuid)".format(
+            prefix=self._quote('%s:%s:' % (self.key, table_name)),
+            column_sql=column_sql,
+        )
+
+    def to_uuid(self, table_name, old_id):
+        text = '%s:%s:%s' % (self.key, table_name, old_id)
+        return uuid.UUID(hashlib.md5(text.encode('utf-8')).hexdigest())
+
+
+class TimeOrderedUuidStrategy(UuidStrategy):
+    """
+    Time ordered (version 7) uuids: the milliseconds of clock_timestamp() followed by random bits, so the new
+    values are appended to the right of the PK / FK indexes instead of being scattered across them.
+    """
+
+    def __init__(self, native=False):
+        """
+        :param native: use the uuidv7() function of Postgres 18+ instead of building the uuid in SQL.
+        """
+        self.native = native
+
+    def build_value(self, table_name, column_sql):
+        return self.build_default()
+
+    def build_default(self):
+        if self.native:
+            return 'uuidv7()'
+        return (
+            "cast("
+            "lpad(to_hex(floor(extract(epoch from clock_timestamp()) * 1000)::bigint), 12, '0') || '7' || "
+            "substr(md5(random()::text), 1, 3) || substr('89ab', floor(random() * 4)::int + 1, 1) || "
+            "substr(md5(random()::text), 1, 15) as uuid)"
+        )
+
+
+class OrderPreservingUuidStrategy(TimeOrderedUuidStrategy):
+    """
+    Version 7 uuids that keep the order of the old ids: a fixed timestamp, 12 bits taken from the md5 of the table
+    name and the old id in the last 60 bits. The existing rows keep their physical / index order and the new rows
+    (time ordered uuids by default) are sorted after them. The old ids must be between 0 and 2^60 - 1.
+    """
+    deterministic = True
+
+    def __init__(self, timestamp_ms=0, native=False):
+        """
+        :param timestamp_ms: the fixed timestamp (milliseconds since 1970) of the uuids of the existing rows. It
+        must be older than the conversion, so the new rows are sorted after them.
+        """
+        super().__init__(native)
+        self.timestamp_ms = timestamp_ms
+
+    def _build_prefix(self, table_name):
+        return '%012x7%s8' % (self.timestamp_ms, hashlib.md5(table_name.encode('utf-8')).hexdigest()[:3])
+
+    def build_value(self, table_name, column_sql):
+        """
+        The ids out of the range fail (as in to_uuid), instead of being truncated: the cast of the error message
+        to uuid raises it.
+        """
+        return (
+            "cast(case when ({column_sql})::bigint between 0 and {max_id} "
+            "then {prefix} || lpad(to_hex(({column_sql})::bigint), 15, '0') "
+            "else {message} || ({column_sql})::text end as uuid)"
+        ).format(
+            prefix=self._quote(self._build_prefix(table_name)),
+            column_sql=column_sql,
+            max_id=(1 << 60) - 1,
+            message=self._quote('Id out of the range of OrderPreservingUuidStrategy: '),
+        )
+
+    def to_uuid(self, table_name, old_id):
+        if not 0 <= int(old_id) < 1 << 60:
+            raise Exception('Id out of the range of OrderPreservingUuidStrategy: %s' % old_id)
+        return uuid.UUID('%s%015x' % (self._build_prefix(table_name), int(old_id)))
+
+
+class IdReplacer:
+    """
+    Perform the ID replace.
+    """
+    THROTTLE_CEILINGS = ['max_replication_lag', 'max_wal_rate', 'max_active_backends']
+
+    # the default journal table (params journal_name)
+    JOURNAL_NAME = 'pk2uuid_journal'
+
+    # session parameters (GUCs) by phase ("*" for every phase), chosen by params profile
+    PROFILES = {
+        'default': {},
+        'bulk': {
+            '*': {'synchronous_commit': 'off', 'work_mem': '256MB', 'maintenance_work_mem': '1GB'},
+            'Recreating secondary indexes': {'maintenance_work_mem': '2GB', 'max_parallel_maintenance_workers': 4},
+            'Vacuuming tables': {'maintenance_work_mem': '1GB'},
+        },
+        'gentle': {
+            '*': {'work_mem': '16MB', 'maintenance_work_mem': '128MB', 'max_parallel_maintenance_workers': 0},
+        },
+    }
+
+    def __init__(self):
+        self.schema_graph = None
+        self.primary_keys = None
+        self.foreign_keys = None
+        self.executor = None
+
+    def execute(self, *args, **kwargs):
+        """
+        Replace the sequencial Id by the UUID.
+        :param args: some arguments.
+        :param kwargs: some key-arguments.
+
+        """
+        start_time = time.time()
+        params = kwargs.get('params')
+        if params is None:
+            raise Exception('Params not defined')
+        utils = DatabaseUtils()
+        kwargs['utils'] = utils
+        workers = params.get('workers', 1)
+        if workers > 1 and not params['autocommit']:
+            raise Exception('Parallel execution (workers > 1) requires autocommit')
+        conn = utils.get_connection(params)
+        try:
+            with conn:
+                if params.get('journal'):
+                    utils.journal = Journal(
+                        self._build_table_name(params['schema'], params.get('journal_name', self.JOURNAL_NAME))
+                    )
+                    utils.journal.load(conn)
+                    self._check_journal_engine(conn, utils.journal)
+                # Primary Key
+                self._discover(conn, utils.journal, params.get('snapshot_file'), params)
+                if workers > 1:
+                    self.executor = ParallelExecutor(params, workers, self._get_table_sizes(conn))
+                if params.get('instrumentation') or params.get('report_file'):
+                    utils.instrumentation = Instrumentation(params, self.on_statement, self.on_phase)
+                    utils.instrumentation.start_monitor()
+                if any(params.get(name) is not None for name in self.THROTTLE_CEILINGS):
+                    if not params.get('batch_size'):
+                        raise Exception('Throttling (%s) requires batch_size' % ', '.join(self.THROTTLE_CEILINGS))
+                    utils.throttle = Throttle(params)
+                if params.get('verify'):
+                    Utils.print_message("Computing the verification hashes")
+                    before = self._load_or_record(
+                        conn, utils.journal, 'verify',
+                        lambda connection: self._compute_hashes(connection, False, params['serial_name'])
+                    )
+                kwargs['rows'] = self.primary_keys
+                self.set_up(conn, *args, **kwargs)
+                try:
+                    self._replace(conn, *args, **kwargs)
+                    if params.get('mapping_dir'):
+                        kwargs['rows'] = self.primary_keys
+                        self._run_phase(
+                            conn, "Exporting id mappings", self._export_id_mappings, *args, **kwargs, parallel=False,
+                            pipeline=False
+                        )
+                    if params.get('verify'):
+                        Utils.print_message("Verifying the conversion")
+                        self._verify(before, self._compute_hashes(conn, True, params['serial_name']))
+                    if params.get('vacuum'):
+                        kwargs['rows'] = self._build_conversion_plan()
+                        self._run_phase(
+                            conn, "Vacuuming tables", self._vacuum_table, *args, **kwargs, group_by_table=False
+                        )
+                except:
+                    if params.get('rebuild_indexes') and utils.journal is None and conn.autocommit:
+                        self._restore_indexes(conn)
+                    raise
+                finally:
+                    kwargs['rows'] = self.primary_keys
+                    self.tear_down(conn, *args, **kwargs)
+        finally:
+            if self.executor is not None:
+                self.executor.close()
+                self.executor = None
+            if utils.instrumentation is not None:
+                utils.instrumentation.stop_monitor()
+                if params.get('report_file'):
+                    utils.instrumentation.write_report(params['report_file'])
+            conn.close()
+
+        seconds = round(time.time() - start_time, 2)
+        duration = Utils.to_hour_minute_second(seconds)
+        print("------")
+        print("FINISH")
+        print("------")
+        print("--- %s DURATION ---" % duration)
+        print("------")
+
+    def plan(self, *args, **kwargs):
+        """
+        Dry run: build the ordered SQL script of the conversion and estimate, from the catalog statistics, the
+        volume rewritten, the WAL generated and the runtime of each table. Nothing is modified.
+        Params: plan_file receives the script; plan_throughput is the rewrite speed, in bytes per second, used to
+        estimate the runtime (default 50 MB/s).
+        :return: a dict with script (a list of dicts with step, table_name, sql and batched), tables and totals.
+        """
+        params = kwargs.get('params')
+        if params is None:
+            raise Exception('Params not defined')
+        utils = ScriptDatabaseUtils()
+        kwargs['utils'] = utils
+        conn = DatabaseUtils().get_connection(dict(params, autocommit=False))
+        try:
+            conn.set_session(readonly=True)
+            with conn:
+                self._discover(conn, snapshot_file=params.get('snapshot_file'), params=params)
+                kwargs['rows'] = self.primary_keys
+                utils.step = 'set_up'
+                self.set_up(conn, *args, **kwargs)
+                self._replace(conn, *args, **kwargs)
+                kwargs['rows'] = self.primary_keys
+                utils.step = 'tear_down'
+                self.tear_down(conn, *args, **kwargs)
+                statistics = self._get_table_statistics(conn)
+        finally:
+            conn.close()
+
+        result = self._estimate(utils.statements, statistics, params.get('plan_throughput', 50 * 1024 * 1024))
+        if params.get('plan_file'):
+            self._write_script(utils.statements, params['plan_file'])
+        for table in result['tables']:
+            print("%s: %d rows, %d rewrites, %d MB rewritten, ~%s" % (
+                table['table_name'], table['rows'], table['rewrites'], table['rewrite_bytes'] // (1024 * 1024),
+                Utils.to_hour_minute_second(table['seconds']),
+            ))
+        print("--- %d statements, %d MB rewritten, %d MB of WAL, ~%s DURATION ---" % (
+            len(utils.statements), result['totals']['rewrite_bytes'] // (1024 * 1024),
+            result['totals']['wal_bytes'] // (1024 * 1024), Utils.to_hour_minute_second(result['totals']['seconds']),
+        ))
+        return result
+
+    def _get_table_statistics(self, connection):
+        sql = """
+        select
+          n.nspname || '.' || c.relname as table_name, greatest(c.reltuples, 0)::bigint as rows,
+          c.relpages::bigint * current_setting('block_size')::bigint as table_bytes,
+          coalesce((select sum(pg_relation_size(i.indexrelid)) from pg_index i where i.indrelid = c.oid), 0)::bigint
+            as index_bytes,
+          (select count(*) from pg_index i where i.indrelid = c.oid) as indexes,
+          (select count(*) from pg_constraint f where f.contype = 'f' and c.oid in (f.conrelid, f.confrelid))
+            as dependencies
+        from pg_class c
+        inner join pg_namespace n on n.oid = c.relnamespace
+        where c.relkind in ('r', 'p')
+        and n.nspname not in ('pg_catalog', 'information_schema');
+        """
+        rows = DatabaseUtils().select(connection, sql)
+        return dict((row['table_name'], row) for row in rows)
+
+    def _is_rewrite(self, sql):
+        """
+        Whether the command rewrites the whole table and its indexes (updates, type changes, stored generated
+        columns).
+        """
+        sql = ' '.join(sql.lower().split())
+        return (
+            re.search(r'(^|;) ?update ', sql) is not None
+            or re.search(r'\btype \S+( using\b|;|,|$)', sql) is not None
+            or ' generated always as ' in sql
+        )
+
+    def _is_copy(self, sql):
+        """
+        Whether the command copies the whole table into another one (insert ... select), without its indexes.
+        """
+        return False
+
+    def _count_index_builds(self, sql):
+        """
+        The indexes built by the command: created, or created by a PK / unique constraint (not "using index").
+        """
+        sql = ' '.join(sql.lower().split())
+        return (
+            len(re.findall(r'\bcreate (unique )?index\b', sql))
+            + len(re.findall(r'\badd constraint \S+ (primary key|unique) \(', sql))
+        )
+
+    def _estimate(self, statements, statistics, throughput):
+        tables = OrderedDict()
+        for statement in statements:
+            table_name = statement['table_name']
+            if table_name is None or table_name not in statistics:
+                continue
+            row = statistics[table_name]
+            table = tables.setdefault(table_name, {
+                'table_name': table_name,
+                'rows': row['rows'],
+                'table_bytes': row['table_bytes'],
+                'index_bytes': row['index_bytes'],
+                'indexes': row['indexes'],
+                'dependencies': row['dependencies'],
+                'statements': 0,
+                'rewrites': 0,
+                'copies': 0,
+                'index_builds': 0,
+            })
+            table['statements'] += 1
+            if self._is_rewrite(statement['sql']):
+                table['rewrites'] += 1
+            if self._is_copy(statement['sql']):
+                table['copies'] += 1
+            table['index_builds'] += self._count_index_builds(statement['sql'])
+        for table in tables.values():
+            # each rewrite writes a new version of every row and of every index entry, each copy every row and each
+            # index build an index (of the average size), all of it WAL logged
+            table['rewrite_bytes'] = (
+                table['rewrites'] * (table['table_bytes'] + table['index_bytes'])
+                + table['copies'] * table['table_bytes']
+                + table['index_builds'] * table['index_bytes'] // max(table['indexes'], 1)
+            )
+            table['wal_bytes'] = table['rewrite_bytes']
+            table['seconds'] = table['rewrite_bytes'] / throughput
+        tables = sorted(tables.values(), key=lambda table: table['seconds'], reverse=True)
+        totals = {
+            'rewrite_bytes': sum(table['rewrite_bytes'] for table in tables),
+            'wal_bytes': sum(table['wal_bytes'] for table in tables),
+            'seconds': sum(table['seconds'] for table in tables),
+        }
+        return {'script': statements, 'tables': tables, 'totals': totals}
+
+    def _write_script(self, statements, file_name):
+        with open(file_name, 'w') as script:
+            step = None
+            for statement in statements:
+                if statement['step'] != step:
+                    step = statement['step']
+                    script.write('\n-- %s\n' % step)
+                if statement['batched']:
+                    script.write('-- in batches, by ranges of the integer key\n')
+                script.write(statement['sql'] + '\n')
+
+    def _check_journal_engine(self, conn, journal):
+        """
+        Record the engine (class name) in the journal, or check it is the one of the run that wrote the journal:
+        the phases of the engines share names, a run would skip the phases finished by another engine.
+        """
+        engine = type(self).__name__
+        detail = journal.get_detail(conn, 'engine', 'class')
+        if detail is None:
+            journal.record(conn, 'engine', 'class', engine)
+        elif detail != engine:
+            raise Exception('The journal %s was written by %s, not by %s: drop it or set another journal_name' % (
+                journal.table_name, detail, engine
+            ))
+
+    def _discover(self, conn, journal=None, snapshot_file=None, params=None):
+        """
+        Read the primary and foreign keys to convert into the schema graph. With a journal, the keys read by the
+        first run are recorded and reused by the reruns (when the converted keys are not integer anymore). With a
+        snapshot file, the keys are read from it when it exists, or saved to it (before the filters of the params).
+        A SchemaGraph given in params['schema_graph'] is used instead of both.
+        """
+        detail = journal.get_detail(conn, 'discover', 'keys') if journal is not None else None
+        if detail is not None:
+            self.schema_graph = SchemaGraph.from_dict(json.loads(detail))
+        else:
+            given = params is not None and params.get('schema_graph') is not None
+            if given:
+                self.schema_graph = params['schema_graph']
+            elif snapshot_file is not None and os.path.exists(snapshot_file):
+                self.schema_graph = SchemaGraph.load(snapshot_file)
+            else:
+                primary_keys, foreign_keys = self._get_keys(conn)
+                self.schema_graph = SchemaGraph(
+                    primary_keys, foreign_keys, self._get_indexes(conn), self._get_partitions(conn)
+                )
+                if snapshot_file is not None:
+                    self.schema_graph.save(snapshot_file)
+            if params is not None:
+                self.schema_graph = self._filter_schema_graph(self.schema_graph, params)
+            if given:
+                self._check_schema_graph(conn, self.schema_graph, params)
+            for row in self.schema_graph.primary_keys:
+                if self.schema_graph.get_table(row['table_schema'], row['table_name'])['partitions']:
+                    raise Exception(
+                        'The PK of the partitioned table %s.%s is its partition key, its type can not be changed' % (
+                            row['table_schema'], row['table_name']
+                        )
+                    )
+        if journal is not None and detail is None:
+            journal.record(conn, 'discover', 'keys', json.dumps(self.schema_graph.to_dict()))
+        self.primary_keys = self.schema_graph.primary_keys
+        self.foreign_keys = self.schema_graph.foreign_keys
+
+    def _check_schema_graph(self, conn, schema_graph, params=None):
+        """
+        Check that a schema graph read elsewhere (in another database or schema) has the same keys, and the same
+        secondary indexes over them (dropped and recreated with rebuild_indexes), as the schemas it covers in this
+        database, selected by the same filters.
+        """
+        schemas = sorted(set(table['table_schema'] for table in schema_graph.tables.values()))
+        primary_keys, foreign_keys = self._get_keys(conn)
+        found = SchemaGraph(primary_keys, foreign_keys, self._get_indexes(conn))
+        if params is not None:
+            found = found.filter(**self._get_filters(params))
+        found = found.filter(include_schemas=schemas)
+
+        def get_keys(graph):
+            keys = set(
+                ('pk', row['table_schema'], row['table_name'], row['column_name'], row['constraint_name'])
+                for row in graph.primary_keys
+            )
+            keys.update(
+                ('fk', row['table_schema'], row['table_name'], row['column_name'], row['constraint_name'])
+                for row in graph.foreign_keys
+            )
+            keys.update(
+                ('index', row['table_schema'], row['table_name'], row['index_name'], row['definition'])
+                for row in graph.indexes
+            )
+            return keys
+
+        expected = get_keys(schema_graph)
+        found = get_keys(found)
+        if expected != found:
+            differences = sorted(expected ^ found)
+            raise Exception('The keys of the schema graph do not match the database: %s' % ', '.join(
+                '%s %s.%s.%s (%s)' % key for key in differences[:10]
+            ))
+
+    def _get_filters(self, params):
+        names = ['include_schemas', 'exclude_schemas', 'include_tables', 'exclude_tables']
+        return dict((name, params.get(name) or ()) for name in names)
+
+    def _filter_schema_graph(self, schema_graph, params):
+        """
+        Apply the include_schemas, exclude_schemas, include_tables and exclude_tables params to the schema graph.
+        """
+        filters = self._get_filters(params)
+        if not any(filters.values()):
+            return schema_graph
+        filtered = schema_graph.filter(**filters)
+        Utils.print_message("Converting %d of %d primary keys and %d of %d foreign keys" % (
+            len(filtered.primary_keys), len(schema_graph.primary_keys), len(filtered.foreign_keys),
+            len(schema_graph.foreign_keys)
+        ))
+        return filtered
+
+    def _build_sql_to_compute_hashes(self, plan, converted, serial_name=None):
+        """
+        The select of the row count and the order independent hashes (sum of hashtextextended) of the keys and of
+        each (key, FK) pair of a table. Before the conversion, the keys are the integer ids; after it (converted),
+        they are the serial columns, the FK values being mapped back to the serial column of the referenced table.
+        Tables without a converted PK hash only the FK values.
+        """
+        table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+        primary_key = plan['primary_key']
+        key_column = None
+        if primary_key is not None:
+            key_column = serial_name if converted else primary_key['column_name']
+        key_sql = "t.\"%s\"::text" % key_column if key_column is not None else "''"
+        values = [
+            'count(*)::bigint as rows',
+            'coalesce(sum(hashtextextended({key_sql}, 0)), 0)::text as keys'.format(key_sql=key_sql),
+        ]
+        joins = []
+        for number, row in enumerate(plan['foreign_keys']):
+            if converted:
+                referenced = self.schema_graph.get_table(row['foreign_table_schema'], row['foreign_table_name'])
+                joins.append('left join {table_name} r{number} on r{number}."{primary_key}" = t."{column_name}"'.format(
+                    table_name=self._build_table_name(row['foreign_table_schema'], row['foreign_table_name']),
+                    number=number,
+                    primary_key=referenced['primary_key']['column_name'],
+                    column_name=row['column_name'],
+                ))
+                value_sql = 'r%d."%s"::text' % (number, serial_name)
+            else:
+                value_sql = 't."%s"::text' % row['column_name']
+            values.append(
+                "coalesce(sum(hashtextextended({key_sql} || ':' || coalesce({value_sql}, ''), 0)), 0)::text "
+                "as fk_{number}".format(
+                    key_sql=key_sql,
+                    value_sql=value_sql,
+                    number=number,
+                )
+            )
+        sql = """
+        select {values}
+        from {table_name} t{joins};
+        """.format(
+            values=',\n          '.join(values),
+            table_name=table_name,
+            joins=''.join('\n        ' + join for join in joins),
+        )
+        return sql
+
+    def _compute_hashes(self, connection, converted, serial_name):
+        """
+        Compute the row counts and hashes of every converted table, in parallel when running with workers.
+        :return: a dict table name => dict with rows, keys and the hash of each FK constraint.
+        """
+        plans = self._build_conversion_plan()
+        queries = OrderedDict(
+            (self._build_table_name(plan['table_schema'], plan['table_name']),
+             self._build_sql_to_compute_hashes(plan, converted, serial_name))
+            for plan in plans
+        )
+        if self.executor is not None:
+            results = self.executor.select(queries)
+        else:
+            results = dict((name, DatabaseUtils().select(connection, sql)) for name, sql in queries.items())
+        hashes = OrderedDict()
+        for plan in plans:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            row = results[table_name][0]
+            hashes[table_name] = {'rows': row['rows'], 'keys': row['keys']}
+            for number, foreign_key in enumerate(plan['foreign_keys']):
+                hashes[table_name][foreign_key['constraint_name']] = row['fk_%d' % number]
+        return hashes
+
+    def _verify(self, before, after):
+        """
+        Compare the row counts and hashes computed before and after the conversion.
+        """
+        mismatches = []
+        for table_name, values in before.items():
+            for name, value in values.items():
+                if after.get(table_name, {}).get(name) != value:
+                    mismatches.append('%s (%s)' % (table_name, name))
+        if mismatches:
+            raise Exception('Verification failed: ' + ', '.join(mismatches))
+        Utils.print_message("...%d tables verified" % len(before))
+
+    def _build_sql_to_vacuum(self, table_name):
+        return 'vacuum (analyze) {table_name};'.format(table_name=table_name)
+
+    def _vacuum_table(self, connection, *args, **kwargs):
+        """
+        Vacuum and analyze the converted tables (the partitions of the partitioned tables one by one), removing the
+        dead rows left by the updates and refreshing the statistics of the new columns.
+        """
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        if not connection.autocommit:
+            Utils.print_message("...skipped: vacuum requires autocommit")
+            return
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            for name in self._get_leaf_partitions(table_name) or [table_name]:
+                Utils.print_message("...vacuuming " + name)
+
+                sql = self._build_sql_to_vacuum(name)
+                if sql is not None:
+                    utils.execute(connection, sql, name)
+
+    def _build_mapping_file_name(self, mapping_dir, table_schema, table_name):
+        return os.path.join(mapping_dir, '%s.%s.idmap' % (table_schema, table_name))
+
+    def _export_id_mappings(self, connection, *args, **kwargs):
+        """
+        Export the old id => uuid mapping of each converted table to params['mapping_dir'] (see id_mapping).
+        """
+        params = kwargs['params']
+        rows = kwargs['rows']
+        exporter = IdMappingExporter(params.get('mapping_fetch_size', 10000))
+        os.makedirs(params['mapping_dir'], exist_ok=True)
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            file_name = self._build_mapping_file_name(params['mapping_dir'], row['table_schema'], row['table_name'])
+
+            Utils.print_message("...exporting " + table_name + " to " + file_name)
+
+            count = exporter.export(connection, table_name, params['serial_name'], row['column_name'], file_name)
+            Utils.print_message("...%d ids" % count)
+
+    def _load_or_record(self, conn, journal, unit, function):
+        """
+        Read, from the database, information needed by the later phases. With a journal, it is recorded by the first
+        run and reused by the reruns (when the database was already changed).
+        :param function: a function that receives the connection and returns the information (JSON serializable).
+        """
+        detail = journal.get_detail(conn, 'discover', unit) if journal is not None else None
+        if detail is not None:
+            return json.loads(detail)
+        value = function(conn)
+        if journal is not None:
+            journal.record(conn, 'discover', unit, json.dumps(value))
+        return value
+
+    def _replace(self, conn, *args, **kwargs):
+        """
+        Perform the phases that replace the ids, between the set_up and the tear_down.
+        :param conn: a opened connection.
+        """
+        params = kwargs['params']
+        deterministic = self._get_uuid_strategy(params).deterministic
+        mapping = params.get('fk_backfill', 'join') == 'mapping' and not deterministic
+
+        if params.get('rebuild_indexes'):
+            kwargs['rows'] = self.schema_graph.indexes
+            self._run_phase(conn, "Dropping secondary indexes", self._drop_index, *args, **kwargs)
+            kwargs['rows'] = self.primary_keys
+
+        self._run_phase(conn, "Droping PK default value", self._drop_pk_default_value, *args, **kwargs)
+
+        if not deterministic:
+            self._run_phase(conn, "Creating temporary pk column", self._create_temporary_column, *args, **kwargs)
+
+            self._run_phase(
+                conn, "Assign values to temporary pk column", self._assign_value_to_temporary_pk_column,
+                *args, **kwargs
+            )
+
+        self._run_phase(conn, "Creating serial column", self._create_serial_column, *args, **kwargs)
+
+        self._run_phase(conn, "Copying pk to serial column", self._copy_pk_column_to_serial_column, *args, **kwargs)
+
+        # Foreign Key
+        kwargs['rows'] = self.foreign_keys
+        self._run_phase(
+            conn, "Dropping fk constraints", self._drop_fk_constraint, *args, **kwargs, parallel=False
+        )
+
+        if mapping:
+            kwargs['rows'] = self._get_referenced_primary_keys()
+            self._run_phase(conn, "Creating id mapping tables", self._create_id_mapping, *args, **kwargs)
+
+        if mapping or deterministic:
+            kwargs['rows'] = self.foreign_keys
+            self._run_phase(
+                conn, "Changing fk to uuid", self._change_fk_column_to_uuid_using_lookup, *args, **kwargs
+            )
+        else:
+            self._run_phase(
+                conn, "Changing fk to varchar", self._change_fk_column_to_datatype, *args, **kwargs,
+                data_type='varchar'
+            )
+
+            self._run_phase(
+                conn, "Copying pk column to fk column (uuid)", self._copy_pk_values_to_fk_columns, *args, **kwargs
+            )
+
+            self._run_phase(
+                conn, "Changing fk to uuid", self._change_fk_column_to_datatype, *args, **kwargs, data_type='uuid'
+            )
+
+        kwargs['rows'] = self.primary_keys
+        if deterministic:
+            self._run_phase(conn, "Changing pk to uuid", self._change_pk_column_to_uuid_using_lookup, *args, **kwargs)
+        else:
+            self._run_phase(conn, "Changing pk to uuid", self._change_column_to_uuid, *args, **kwargs)
+
+            self._run_phase(
+                conn, "Setting the uuid primary key value", self._copy_temporary_column_to_pk, *args, **kwargs
+            )
+
+        self._run_phase(conn, "Defining a default value to pk", self._add_default_value_to_pk, *args, **kwargs)
+
+        self._recreate_fk_constraints(conn, *args, **kwargs)
+
+        if not deterministic:
+            kwargs['rows'] = self.primary_keys
+            self._run_phase(conn, "Drop temporary column", self._drop_temporary_column, *args, **kwargs)
+
+        if mapping:
+            kwargs['rows'] = self._get_referenced_primary_keys()
+            self._run_phase(conn, "Drop id mapping tables", self._drop_id_mapping, *args, **kwargs)
+
+        if params.get('rebuild_indexes'):
+            self._recreate_indexes(conn, *args, **kwargs)
+
+    def _recreate_fk_constraints(self, conn, *args, **kwargs):
+        """
+        Recreate the FK constraints. Adding a FK locks the referenced table too, so the constraints are created
+        serially. With params fk_not_valid, they are added as "not valid" (no scan, instantaneous) and then validated
+        in parallel, each validation locking only its own table against schema changes.
+        """
+        not_valid = kwargs['params'].get('fk_not_valid', False)
+        kwargs['rows'] = self.foreign_keys
+        self._run_phase(
+            conn, "Recreating fk constraints", self._create_fk_constraint, *args, **kwargs, parallel=False,
+            not_valid=not_valid
+        )
+        if not_valid:
+            self._run_phase(conn, "Validating fk constraints", self._validate_fk_constraint, *args, **kwargs)
+
+    def _recreate_indexes(self, conn, *args, **kwargs):
+        """
+        Recreate the secondary indexes dropped before the conversion, in parallel (the indexes of a same table too).
+        """
+        kwargs['rows'] = self.schema_graph.indexes
+        self._run_phase(
+            conn, "Recreating secondary indexes", self._create_index, *args, **kwargs, group_by_table=False,
+            settings=self._get_index_settings(kwargs['params'])
+        )
+
+    def _restore_indexes(self, conn):
+        """
+        Recreate, after a failure, the secondary indexes dropped before the conversion: without a journal, a rerun
+        would not know them. The indexes that can not be created (their columns changed) are printed, to be
+        created by hand.
+        """
+        utils = DatabaseUtils()
+        Utils.print_message("Restoring the secondary indexes")
+        for row in self.schema_graph.indexes:
+            sql = self._build_sql_to_create_index(row['definition'])
+            try:
+                utils.execute(conn, sql)
+            except psycopg2.Error:
+                Utils.print_message("...can not restore the index, create it by hand: " + sql)
+
+    def _run_phase(
+            self, conn, message, method, *args, parallel=True, group_by_table=True, settings=None, pipeline=True,
+            **kwargs
+    ):
+        """
+        Perform a phase. When running with workers, the commands of the phase are collected and run by the
+        ParallelExecutor, table by table; the next phase only starts when all the tables have finished.
+        :param conn: a opened connection.
+        :param message: the message printed when the phase starts.
+        :param method: the phase method.
+        :param parallel: False to always run the phase serially, on the given connection.
+        :param group_by_table: False to let the workers run commands of a same table at the same time.
+        :param settings: a dict of session parameters (GUCs) set while the phase runs.
+        :param pipeline: False to never send the commands of the phase in chunks (params pipeline), for the phases
+        that manage their own connections or transactions.
+        """
+        utils = kwargs['utils']
+        journal = utils.journal
+        if journal is not None and journal.is_done(message, '*'):
+            Utils.print_message(message + " (already done)")
+            return
+        settings = self._get_phase_settings(message, settings, kwargs['params'])
+        Utils.print_message(message)
+        utils.step = message
+        start_time = time.time()
+        lsn = utils.instrumentation.start_phase(conn) if utils.instrumentation is not None else None
+        try:
+            if self.executor is None or not parallel:
+                if settings:
+                    utils.apply_settings(conn, settings)
+                try:
+                    chunk_size = kwargs['params'].get('pipeline') if pipeline else None
+                    if chunk_size:
+                        kwargs['utils'] = DeferredDatabaseUtils()
+                        method(conn, *args, **kwargs)
+                        utils.execute_pipelined(
+                            conn, kwargs['utils'].tasks, 100 if chunk_size is True else chunk_size
+                        )
+                    else:
+                        method(conn, *args, **kwargs)
+                finally:
+                    if settings:
+                        utils.reset_settings(conn, settings)
+            else:
+                kwargs['utils'] = DeferredDatabaseUtils()
+                method(conn, *args, **kwargs)
+                self.executor.run(kwargs['utils'].tasks, utils, group_by_table, settings, pipeline)
+        finally:
+            utils.step = None
+        if utils.instrumentation is not None:
+            utils.instrumentation.finish_phase(conn, message, time.time() - start_time, lsn)
+        if journal is not None:
+            journal.record(conn, message, '*')
+
+    def _get_phase_settings(self, message, settings, params):
+        """
+        The session parameters of a phase: the ones of the profile (params profile, a name of PROFILES or a dict
+        with the same structure) for every phase and for the phase, then the ones given by the phase.
+        """
+        profile = params.get('profile') or 'default'
+        if not isinstance(profile, dict):
+            if profile not in self.PROFILES:
+                raise Exception('Unknown profile %s' % profile)
+            profile = self.PROFILES[profile]
+        result = dict(profile.get('*', {}))
+        result.update(profile.get(message, {}))
+        result.update(settings or {})
+        return result or None
+
+    def on_statement(self, record):
+        """
+        Hook called, when the instrumentation is enabled, after each SQL command.
+        :param record: a dict with step, table_name, statement, started_at, seconds, rows, wal_bytes (approximate:
+        the WAL generated by the whole server while the command ran) and lock_wait_seconds.
+        """
+        pass
+
+    def on_phase(self, record):
+        """
+        Hook called, when the instrumentation is enabled, after each phase.
+        :param record: a dict with step, seconds, statements, rows, wal_bytes and lock_wait_seconds.
+        """
+        pass
+
+    def _get_uuid_strategy(self, params):
+        return params.get('uuid_strategy') or RandomUuidStrategy()
+
+    def _is_unlogged_scratch(self, params):
+        """
+        The scratch tables (id mappings) are unlogged unless params unlogged_scratch is False. With a journal they
+        are always logged: a crash empties the unlogged tables, and the rerun would skip the phase that filled them.
+        """
+        return params.get('unlogged_scratch', True) and not params.get('journal')
+
+    def _build_uuid_lookup(self, schema_name, table_name, column_sql, *args, **kwargs):
+        """
+        The SQL expression that gives the new uuid of an old id of a table: the deterministic strategy expression,
+        or a call to the lookup function of the id mapping of the table.
+        """
+        strategy = self._get_uuid_strategy(kwargs['params'])
+        if strategy.deterministic:
+            return strategy.build_value(self._build_table_name(schema_name, table_name), column_sql)
+        return '%s(%s)' % (self._build_mapping_function_name(schema_name, table_name), column_sql)
+
+    def _get_table_sizes(self, connection):
+        sql = """
+        select n.nspname || '.' || c.relname as table_name, pg_total_relation_size(c.oid) as size
+        from pg_class c
+        inner join pg_namespace n on n.oid = c.relnamespace
+        where c.relkind in ('r', 'p')
+        and n.nspname not in ('pg_catalog', 'information_schema');
+        """
+        rows = DatabaseUtils().select(connection, sql)
+        return dict((row['table_name'], row['size']) for row in rows)
+
+    def _build_sql_to_enable_trigger(self, table_name, action, restrict):
+        sql = "alter table if exists {table_name} {action} trigger {restrict};".format(
+            table_name=table_name,
+            action=action,
+            restrict=restrict,
+        )
+        return sql
+
+    def _enable_trigger(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        action = kwargs['action']
+        for row in rows:
+            table_schema = row['table_schema']
+            table_name = row['table_name']
+            table_name = self._build_table_name(table_schema, table_name)
+
+            Utils.print_message("..." + action + " trigger, if exists, on " + table_name)
+
+            sql = self._build_sql_to_enable_trigger(table_name, action, restrict='all')
+            if sql is None:
+                return
+            try:
+                utils.execute(connection, sql)
+                continue
+            except:
+                pass
+            sql = self._build_sql_to_enable_trigger(table_name, action, restrict='user')
+            if sql is not None:
+                utils.execute(connection, sql)
+
+    def set_up(self, connection, *args, **kwargs):
+        kwargs['action'] = 'disable'
+        Utils.print_message("Disabling trigger")
+        self._enable_trigger(connection, *args, **kwargs)
+
+    def tear_down(self, connection, *args, **kwargs):
+        kwargs['action'] = 'enable'
+        Utils.print_message("Enabling trigger")
+        self._enable_trigger(connection, *args, **kwargs)
+
+    def _build_sql_to_add_default_value(self, table_name, column_name, value='gen_random_uuid()'):
+        sql = 'alter table if exists {table_name} alter column "{column_name}" set default {value};'.format(
+            table_name=table_name,
+            column_name=column_name,
+            value=value,
+        )
+        return sql
+
+    def _add_default_value_to_pk(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        value = self._get_uuid_strategy(kwargs['params']).build_default()
+
+        for row in rows:
+            table_schema = row['table_schema']
+            table_name = row['table_name']
+            table_name = self._build_table_name(table_schema, table_name)
+            column_name = row['column_name']
+
+            Utils.print_message("...adding default value to PK " + table_name + "." + column_name)
+
+            sql = self._build_sql_to_add_default_value(table_name, column_name, value)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_drop_default_value(self, table_name, column_name):
+        sql = 'alter table if exists {table_name} alter column "{column_name}" drop default;'.format(
+            table_name=table_name,
+            column_name=column_name,
+        )
+        return sql
+
+    def _drop_column_default_value(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            column_name = row['column_name']
+            sql = self._build_sql_to_drop_default_value(table_name, column_name)
+            utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_copy_pk_values_to_fk_columns(
+            self, table_name, column_name, temp_name, foreign_table_name, foreign_column_name, condition=None
+    ):
+        sql = """
+        update {table_name} a 
+        set "{column_name}" = x."{temp_name}"::varchar
+        from {foreign_table_name} x
+        where a."{column_name}"::varchar = x."{foreign_column_name}"::varchar{condition};
+        """.format(
+            table_name=table_name,
+            temp_name=temp_name,
+            foreign_table_name=foreign_table_name,
+            column_name=column_name,
+            foreign_column_name=foreign_column_name,
+            condition='' if condition is None else ' and ' + condition,
+        )
+        return sql
+
+    def _copy_pk_values_to_fk_columns(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+
+        for row in rows:
+            table_schema = row['table_schema']
+            table_name = row['table_name']
+            table_name = self._build_table_name(table_schema, table_name)
+
+            column_name = row['column_name']
+            foreign_table_name = self._build_table_name(row['foreign_table_schema'], row['foreign_table_name'])
+            foreign_column_name = row['foreign_column_name']
+            temp_name = self._build_temp_column_name(foreign_column_name)
+
+            Utils.print_message("...copying pk => fk " + table_name + "." + column_name)
+
+            # the values of the row are bound now: the command may be built later, by a parallel worker
+            def build_sql(
+                    condition, table_name=table_name, column_name=column_name, temp_name=temp_name,
+                    foreign_table_name=foreign_table_name, foreign_column_name=foreign_column_name
+            ):
+                return self._build_sql_to_copy_pk_values_to_fk_columns(
+                    table_name, column_name, temp_name, foreign_table_name, foreign_column_name, condition
+                )
+
+            self._execute_update(
+                connection, utils, table_name, build_sql, self._get_primary_key_name(row), kwargs['params'], alias='a'
+            )
+
+    def _get_referenced_primary_keys(self):
+        """
+        Return the primary keys referenced by, at least, one foreign key.
+        """
+        return [
+            row for row in self.primary_keys
+            if any(
+                foreign_key['foreign_column_name'] == row['column_name']
+                for foreign_key in self.schema_graph.get_table(row['table_schema'], row['table_name'])['referenced_by']
+            )
+        ]
+
+    def _build_mapping_table_name(self, schema_name, table_name):
+        return '%s.%s_id2uuid' % (schema_name, table_name)
+
+    def _build_mapping_function_name(self, schema_name, table_name):
+        return '%s.%s_id2uuid_lookup' % (schema_name, table_name)
+
+    def _build_sql_to_create_id_mapping(
+            self, table_name, column_name, value, data_type, mapping_table_name, unlogged=True
+    ):
+        sql = """
+        create {persistence}table if not exists {mapping_table_name} (
+          old_id {data_type} not null, new_id uuid not null
+        );
+        insert into {mapping_table_name} (old_id, new_id) select "{column_name}", {value} from {table_name};
+        alter table {mapping_table_name} add primary key (old_id);
+        analyze {mapping_table_name};
+        """.format(
+            table_name=table_name,
+            column_name=column_name,
+            value=value,
+            data_type=data_type,
+            mapping_table_name=mapping_table_name,
+            persistence='unlogged ' if unlogged else '',
+        )
+        return sql
+
+    def _build_sql_to_create_mapping_function(
+            self, mapping_table_name, mapping_function_name, data_type, volatility='stable'
+    ):
+        sql = """
+        create or replace function {mapping_function_name}(id {data_type}) returns uuid
+        language plpgsql {volatility} as $$
+        declare
+          result uuid;
+        begin
+          if id is null then
+            return null;
+          end if;
+          select new_id into result from {mapping_table_name} where old_id = id;
+          if result is null then
+            raise exception 'The id % is not in the id mapping {mapping_table_name}', id;
+          end if;
+          return result;
+        end $$;
+        """.format(
+            mapping_table_name=mapping_table_name,
+            mapping_function_name=mapping_function_name,
+            data_type=data_type,
+            volatility=volatility,
+        )
+        return sql
+
+    def _build_sql_to_drop_id_mapping(self, mapping_table_name, mapping_function_name, data_type):
+        sql = """
+        drop function if exists {mapping_function_name}({data_type});
+        drop table if exists {mapping_table_name};
+        """.format(
+            mapping_table_name=mapping_table_name,
+            mapping_function_name=mapping_function_name,
+            data_type=data_type,
+        )
+        return sql
+
+    def _build_mapping_value(self, *args, **kwargs):
+        """
+        The SQL expression that gives the new uuid of a row, when the id mapping is filled.
+        """
+        return '"%s"' % self._build_temp_column_name(kwargs['column_name'])
+
+    def _create_id_mapping(self, connection, *args, **kwargs):
+        """
+        Create, for each referenced table, a table (old id => uuid) keyed by the integer id, and a lookup function
+        over it, so the foreign keys can be converted without joining over varchar. The lookup function raises on
+        the ids missing from the mapping, instead of giving null. The tables are unlogged (not written to the WAL
+        nor replicated) unless params unlogged_scratch is False or the journal is on.
+        """
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        unlogged = self._is_unlogged_scratch(kwargs['params'])
+        for row in rows:
+            table_schema = row['table_schema']
+            table_name = self._build_table_name(table_schema, row['table_name'])
+            column_name = row['column_name']
+            data_type = row['data_type']
+            value = self._build_mapping_value(
+                *args,
+                **kwargs,
+                table_schema=table_schema,
+                table_name=table_name,
+                column_name=column_name,
+                data_type=data_type,
+            )
+            mapping_table_name = self._build_mapping_table_name(table_schema, row['table_name'])
+            mapping_function_name = self._build_mapping_function_name(table_schema, row['table_name'])
+
+            Utils.print_message("...creating id mapping " + mapping_table_name)
+
+            sql = self._build_sql_to_create_id_mapping(
+                table_name, column_name, value, data_type, mapping_table_name, unlogged
+            )
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+            sql = self._build_sql_to_create_mapping_function(mapping_table_name, mapping_function_name, data_type)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _drop_id_mapping(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_schema = row['table_schema']
+            mapping_table_name = self._build_mapping_table_name(table_schema, row['table_name'])
+            mapping_function_name = self._build_mapping_function_name(table_schema, row['table_name'])
+
+            Utils.print_message("...dropping id mapping " + mapping_table_name)
+
+            sql = self._build_sql_to_drop_id_mapping(mapping_table_name, mapping_function_name, row['data_type'])
+            if sql is not None:
+                utils.execute(connection, sql, mapping_table_name)
+
+    def _build_sql_to_alter_column_to_uuid_using(self, table_name, column_name, value):
+        sql = """
+        alter table {table_name} alter column "{column_name}" type uuid using {value};
+        """.format(
+            table_name=table_name,
+            column_name=column_name,
+            value=value,
+        )
+        return sql
+
+    def _change_fk_column_to_uuid_using_lookup(self, connection, *args, **kwargs):
+        """
+        Change the FK columns from integer straight to uuid, computing the new value while the column is rewritten:
+        from the deterministic uuid strategy or looking up the id mapping of the referenced table (an index scan
+        over the integer key).
+        """
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            if row['data_type'] == 'uuid':
+                continue
+
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            column_name = row['column_name']
+            value = self._build_uuid_lookup(
+                row['foreign_table_schema'], row['foreign_table_name'], '"%s"' % column_name, *args, **kwargs
+            )
+
+            Utils.print_message("...changing FK datatype " + table_name + "." + column_name + " => uuid")
+
+            sql = self._build_sql_to_alter_column_to_uuid_using(table_name, column_name, value)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _change_pk_column_to_uuid_using_lookup(self, connection, *args, **kwargs):
+        """
+        Change the PK columns from integer straight to uuid, using the deterministic uuid strategy.
+        """
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            if row['data_type'] == 'uuid':
+                continue
+
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            column_name = row['column_name']
+            value = self._build_uuid_lookup(
+                row['table_schema'], row['table_name'], '"%s"' % column_name, *args, **kwargs
+            )
+
+            Utils.print_message("...changing column to UUID " + table_name + "." + column_name)
+
+            sql = self._build_sql_to_alter_column_to_uuid_using(table_name, column_name, value)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_alter_column_datatype(self, table_name, column_name, data_type):
+        sql = """
+        alter table {table_name} alter column "{column_name}" type {data_type} using "{column_name}"::{data_type};
+        """.format(
+            table_name=table_name,
+            column_name=column_name,
+            data_type=data_type,
+        )
+        return sql
+
+    def _build_sql_to_alter_column_to_uuid(self, table_name, column_name):
+        sql = """
+        alter table {table_name} alter column "{column_name}" type uuid 
+        using cast(lpad(to_hex("{column_name}"), 32, '0') as uuid);
+        """.format(
+            table_name=table_name,
+            column_name=column_name,
+        )
+        return sql
+
+    def _change_fk_column_to_datatype(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        data_type = kwargs['data_type']
+        utils = kwargs['utils']
+        for row in rows:
+            column_data_type = row['data_type']
+            if column_data_type == data_type:
+                continue
+
+            schema_name = row['table_schema']
+            table_name = row['table_name']
+            table_name = self._build_table_name(schema_name, table_name)
+            column_name = row['column_name']
+
+            Utils.print_message("...changing FK datatype " + table_name + "." + column_name + " => " + data_type)
+
+            sql = self._build_sql_to_alter_column_datatype(table_name, column_name, data_type)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _change_column_to_uuid(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            data_type = row['data_type']
+            if data_type == 'uuid':
+                continue
+
+            schema_name = row['table_schema']
+            table_name = row['table_name']
+            table_name = self._build_table_name(schema_name, table_name)
+            column_name = row['column_name']
+
+            Utils.print_message("...changing column to UUID " + table_name + "." + column_name)
+
+            sql = self._build_sql_to_alter_column_to_uuid(table_name, column_name)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_drop_constraint(self, table_name, constraint_name):
+        sql = 'alter table {table_name} drop constraint "{constraint_name}";'.format(
+            table_name=table_name,
+            constraint_name=constraint_name,
+        )
+        return sql
+
+    def _build_sql_to_create_constraint(
+            self, table_name, constraint_name, column_name, foreign_table_name, foreign_column_name,
+            match_option, update_rule, delete_rule, not_valid=False
+    ):
+        sql = """
+        alter table {table_name} add constraint "{constraint_name}" 
+        foreign key ("{column_name}") references {foreign_table_name} ("{foreign_column_name}")
+        match {match_option} on delete {delete_rule} on update {update_rule}{not_valid}; 
+        """.format(
+            table_name=table_name,
+            constraint_name=constraint_name,
+            column_name=column_name,
+            foreign_table_name=foreign_table_name,
+            foreign_column_name=foreign_column_name,
             match_option=match_option if match_option != 'NONE' else 'SIMPLE',
             delete_rule=delete_rule,
             update_rule=update_rule,
+            not_valid=' not valid' if not_valid else '',
+        )
+        return sql
+
+    def _build_sql_to_validate_constraint(self, table_name, constraint_name):
+        sql = 'alter table {table_name} validate constraint "{constraint_name}";'.format(
+            table_name=table_name,
+            constraint_name=constraint_name,
+        )
+        return sql
+
+    def _drop_fk_constraint(self, connection, *args, **kwargs):
+        """
+        Drop the FK constraints. Run it serially (parallel=False): dropping a FK locks the referencing and the
+        referenced tables, so the workers would deadlock on the tables referenced by several FKs.
+        """
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            schema_name = row['table_schema']
+            table_name = row['table_name']
+            table_name = self._build_table_name(schema_name, table_name)
+            constraint_name = row['constraint_name']
+
+            Utils.print_message("...dropping FK constraint " + table_name + " " + constraint_name)
+
+            sql = self._build_sql_to_drop_constraint(table_name, constraint_name)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _create_fk_constraint(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        not_valid = kwargs.get('not_valid', False)
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            constraint_name = row['constraint_name']
+            column_name = row['column_name']
+            foreign_table_name = self._build_table_name(row['foreign_table_schema'], row['foreign_table_name'])
+            foreign_column_name = row['foreign_column_name']
+            match_option = row['match_option']
+            update_rule = row['update_rule']
+            delete_rule = row['delete_rule']
+
+            Utils.print_message("...creating FK constraints " + table_name + " " + constraint_name)
+
+            # "not valid" FK constraints can not be added to partitioned tables
+            sql = self._build_sql_to_create_constraint(
+                table_name, constraint_name, column_name, foreign_table_name, foreign_column_name,
+                match_option, update_rule, delete_rule, not_valid and not self._get_leaf_partitions(table_name)
+            )
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _validate_fk_constraint(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            constraint_name = row['constraint_name']
+
+            Utils.print_message("...validating FK constraint " + table_name + " " + constraint_name)
+
+            sql = self._build_sql_to_validate_constraint(table_name, constraint_name)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_update_column(self, table_name, column_name, value, condition=None):
+        sql = 'update {table_name} set "{column_name}" = {value}{condition};'.format(
+            table_name=table_name,
+            column_name=column_name,
+            value=value,
+            condition='' if condition is None else ' where ' + condition,
+        )
+        return sql
+
+    def _get_primary_key_name(self, row):
+        """
+        The integer PK column of the table of the row, or None when the table has no integer PK.
+        """
+        table = self.schema_graph.get_table(row['table_schema'], row['table_name'])
+        if table is None or table['primary_key'] is None:
+            return None
+        return table['primary_key']['column_name']
+
+    def _execute_update(self, connection, utils, table_name, build_sql, key_column, params, alias=None):
+        """
+        Perform an update command at once or, when params has a batch_size and the table has an integer key,
+        in ranges of the key (see DatabaseUtils.execute_in_batches).
+        The updates of a partitioned table are performed partition by partition, each one as its own unit (in
+        parallel, with workers), so each command only locks and rewrites one partition.
+        :param build_sql: a function that receives the condition (or None) and, as table_name, the table to update,
+        and returns the update command.
+        """
+        partitions = self._get_leaf_partitions(table_name)
+        if partitions:
+            for partition_name in partitions:
+                def build_partition_sql(condition, partition_name=partition_name):
+                    return build_sql(condition, table_name=partition_name)
+
+                self._execute_update(connection, utils, partition_name, build_partition_sql, key_column, params, alias)
+            return
+        batch_size = params.get('batch_size')
+        if batch_size and key_column is not None:
+            utils.execute_in_batches(
+                connection, table_name, key_column, build_sql, batch_size, params.get('batch_pause', 0), alias
+            )
+            return
+        sql = build_sql(None)
+        if sql is not None:
+            utils.execute(connection, sql, table_name)
+
+    def _copy_pk_column_to_serial_column(self, connection, *args, **kwargs):
+        serial_name = kwargs['params']['serial_name']
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+
+        for row in rows:
+            table_schema = row['table_schema']
+            table_name = self._build_table_name(table_schema, row['table_name'])
+            column_name = row['column_name']
+
+            Utils.print_message("...copying pk to serial column " + table_name)
+
+            def build_sql(condition, table_name=table_name, column_name=column_name):
+                return self._build_sql_to_update_column(table_name, serial_name, column_name, condition)
+
+            self._execute_update(connection, utils, table_name, build_sql, column_name, kwargs['params'])
+
+    def _build_primary_key_update_command(self, *args, **kwargs):
+        strategy = self._get_uuid_strategy(kwargs['params'])
+        value = strategy.build_value(kwargs['table_name'], '"%s"' % kwargs['primary_key_name'])
+        return kwargs['update_command'].format(value=value)
+
+    def _copy_temporary_column_to_pk(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            column_name = row['column_name']
+            temp_column = self._build_temp_column_name(column_name)
+
+            Utils.print_message("...copying temporary column to PK " + table_name + "." + column_name)
+
+            # the PK is already uuid here: the old ids are walked through the serial column
+            def build_sql(condition, table_name=table_name, column_name=column_name, temp_column=temp_column):
+                return self._build_sql_to_update_column(table_name, column_name, temp_column, condition)
+
+            self._execute_update(
+                connection, utils, table_name, build_sql, kwargs['params']['serial_name'], kwargs['params']
+            )
+
+    def _assign_value_to_temporary_pk_column(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+
+        for row in rows:
+            data_type = row['data_type']
+            table_schema = row['table_schema']
+            table_name = self._build_table_name(table_schema, row['table_name'])
+            column_name = self._build_temp_column_name(row['column_name'])
+
+            Utils.print_message("...assiging " + table_name + "." + column_name)
+
+            def build_sql(
+                    condition, row=row, table_schema=table_schema, table_name=table_name, column_name=column_name,
+                    data_type=data_type
+            ):
+                update_command = self._build_sql_to_update_column(table_name, column_name, '{value}', condition)
+                return self._build_primary_key_update_command(
+                    *args,
+                    **kwargs,
+                    connection=connection,
+                    table_schema=table_schema,
+                    table_name=table_name,
+                    column_name=column_name,
+                    primary_key_name=row['column_name'],
+                    data_type=data_type,
+                    update_command=update_command,
+                )
+
+            self._execute_update(connection, utils, table_name, build_sql, row['column_name'], kwargs['params'])
+
+    def _get_keys(self, connection):
+        """
+        Read, in a single query over pg_constraint / pg_attribute, the integer (single column) primary keys and the
+        integer foreign keys. The constraints inherited by the partitions are left out: they follow the constraints
+        of their partitioned tables.
+        :return: the rows of the primary keys and the rows of the foreign keys.
+        """
+        rows = DatabaseUtils().select(connection, self._build_sql_to_get_keys())
+        primary_key_columns = ['table_oid', 'table_schema', 'table_name', 'column_name', 'data_type', 'constraint_name']
+        primary_keys = [
+            dict((column, row[column]) for column in primary_key_columns) for row in rows if row['kind'] == 'p'
+        ]
+        foreign_keys = [
+            dict((column, value) for column, value in row.items() if column != 'kind') for row in rows
+            if row['kind'] == 'f'
+        ]
+        return primary_keys, foreign_keys
+
+    def _build_sql_to_get_keys(self):
+        sql = """
+        select
+          c.contype as kind, t.oid as table_oid, n.nspname as table_schema, t.relname as table_name,
+          a.attname as column_name, format_type(a.atttypid, a.atttypmod) as data_type, c.conname as constraint_name,
+          ft.oid as foreign_table_oid, fn.nspname as foreign_table_schema, ft.relname as foreign_table_name,
+          fa.attname as foreign_column_name,
+          case c.confmatchtype when 'f' then 'FULL' when 'p' then 'PARTIAL' else 'SIMPLE' end as match_option,
+          case c.confupdtype
+            when 'r' then 'RESTRICT' when 'c' then 'CASCADE' when 'n' then 'SET NULL' when 'd' then 'SET DEFAULT'
+            else 'NO ACTION'
+          end as update_rule,
+          case c.confdeltype
+            when 'r' then 'RESTRICT' when 'c' then 'CASCADE' when 'n' then 'SET NULL' when 'd' then 'SET DEFAULT'
+            else 'NO ACTION'
+          end as delete_rule
+        from pg_constraint c
+        inner join pg_class t on t.oid = c.conrelid
+        inner join pg_namespace n on n.oid = t.relnamespace
+        inner join pg_attribute a on a.attrelid = c.conrelid and a.attnum = c.conkey[1]
+        left join pg_class ft on ft.oid = c.confrelid
+        left join pg_namespace fn on fn.oid = ft.relnamespace
+        left join pg_attribute fa on fa.attrelid = c.confrelid and fa.attnum = c.confkey[1]
+        where c.contype in ('p', 'f')
+        and array_length(c.conkey, 1) = 1
+        and c.conparentid = 0
+        and a.atttypid in ('integer'::regtype, 'bigint'::regtype)
+        and n.nspname not in ('pg_catalog', 'information_schema')
+        order by n.nspname, t.relname, c.conname;
+        """
+        return sql
+
+    def _get_indexes(self, connection):
+        """
+        Read the indexes that do not belong to a constraint (PK, unique, exclusion), with their definitions.
+        """
+        sql = """
+        select
+          n.nspname as table_schema, t.relname as table_name, i.relname as index_name,
+          pg_get_indexdef(x.indexrelid) as definition,
+          array(select a.attname::text from pg_attribute a where a.attrelid = x.indrelid and a.attnum = any(x.indkey))
+            as column_names
+        from pg_index x
+        inner join pg_class i on i.oid = x.indexrelid
+        inner join pg_class t on t.oid = x.indrelid
+        inner join pg_namespace n on n.oid = t.relnamespace
+        where n.nspname not in ('pg_catalog', 'information_schema', 'pg_toast')
+        and not exists (select 1 from pg_constraint c where c.conindid = x.indexrelid and c.contype in ('p', 'u', 'x'))
+        and not exists (select 1 from pg_inherits h where h.inhrelid = x.indexrelid);
+        """
+        rows = DatabaseUtils().select(connection, sql)
+        return [dict(row) for row in rows]
+
+    def _get_partitions(self, connection):
+        """
+        Read the leaf partitions of each (root) partitioned table, walking the partition tree in pg_inherits.
+        """
+        sql = """
+        with recursive tree as (
+          select i.inhparent as root, i.inhrelid as relid
+          from pg_inherits i
+          inner join pg_class p on p.oid = i.inhparent and p.relkind = 'p'
+          where not exists (select 1 from pg_inherits h where h.inhrelid = i.inhparent)
+          union all
+          select tree.root, i.inhrelid from tree inner join pg_inherits i on i.inhparent = tree.relid
+        )
+        select
+          rn.nspname as table_schema, r.relname as table_name, n.nspname as partition_schema,
+          c.relname as partition_name
+        from tree
+        inner join pg_class r on r.oid = tree.root
+        inner join pg_namespace rn on rn.oid = r.relnamespace
+        inner join pg_class c on c.oid = tree.relid and c.relkind = 'r'
+        inner join pg_namespace n on n.oid = c.relnamespace
+        order by rn.nspname, r.relname, n.nspname, c.relname;
+        """
+        rows = DatabaseUtils().select(connection, sql)
+        return [dict(row) for row in rows]
+
+    def _get_leaf_partitions(self, table_name):
+        """
+        The leaf partitions (schema.partition) of a partitioned table; empty for the other tables.
+        """
+        return [
+            self._build_table_name(row['partition_schema'], row['partition_name'])
+            for row in self.schema_graph.partitions
+            if self._build_table_name(row['table_schema'], row['table_name']) == table_name
+        ]
+
+    def _get_index_settings(self, params):
+        """
+        The session parameters used to build the indexes.
+        """
+        names = ['maintenance_work_mem', 'max_parallel_maintenance_workers']
+        return dict((name, params[name]) for name in names if params.get(name) is not None)
+
+    def _build_sql_to_drop_index(self, schema_name, index_name):
+        sql = 'drop index if exists {schema_name}."{index_name}";'.format(
+            schema_name=schema_name,
+            index_name=index_name,
+        )
+        return sql
+
+    def _build_sql_to_create_index(self, definition, concurrently=False):
+        sql = re.sub(
+            r'^CREATE (UNIQUE )?INDEX ',
+            lambda match: 'CREATE {unique}INDEX {concurrently}IF NOT EXISTS '.format(
+                unique=match.group(1) or '',
+                concurrently='CONCURRENTLY ' if concurrently else '',
+            ),
+            definition,
+        )
+        return sql + ';'
+
+    def _drop_index(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+
+            Utils.print_message("...dropping index " + table_name + " " + row['index_name'])
+
+            sql = self._build_sql_to_drop_index(row['table_schema'], row['index_name'])
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _create_index(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        concurrently = kwargs.get('concurrently', False)
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+
+            Utils.print_message("...creating index " + table_name + " " + row['index_name'])
+
+            sql = self._build_sql_to_create_index(row['definition'], concurrently)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _get_primary_keys(self, connection):
+        return self._get_keys(connection)[0]
+
+    def _get_foreign_keys(self, connection):
+        return self._get_keys(connection)[1]
+
+    def _build_temp_column_name(self, column_name):
+        return '%s_temp2replace' % column_name
+
+    def _build_table_name(self, schema_name, table_name):
+        return '%s.%s' % (schema_name, table_name)
+
+    def _build_conversion_plan(self):
+        """
+        Group the primary key and the foreign keys of each table, so all its column changes go in one command.
+        :return: a list of dicts with table_schema, table_name, primary_key (a row or None) and foreign_keys.
+        """
+        return [
+            table for table in self.schema_graph.tables.values()
+            if table['primary_key'] is not None or table['foreign_keys']
+        ]
+
+    def _build_sql_to_rename_column(self, table_name, column_name, new_column_name):
+        sql = 'alter table {table_name} rename column "{column_name}" to "{new_column_name}";'.format(
+            table_name=table_name,
+            column_name=column_name,
+            new_column_name=new_column_name,
+        )
+        return sql
+
+    def _build_sql_to_create_column(self, table_name, column_name, data_type):
+        sql = 'alter table {table_name} add column if not exists "{column_name}" {data_type};'.format(
+            table_name=table_name,
+            column_name=column_name,
+            data_type=data_type,
+        )
+        return sql
+
+    def _build_sql_to_drop_column(self, table_name, column_name):
+        sql = 'alter table {table_name} drop column if exists "{column_name}";'.format(
+            table_name=table_name,
+            column_name=column_name,
+        )
+        return sql
+
+    def _create_serial_column(self, connection, *args, **kwargs):
+        column_name = kwargs['params']['serial_name']
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+
+        for row in rows:
+            schema_name = row['table_schema']
+            table_name = row['table_name']
+            data_type = row['data_type']
+            table_name = self._build_table_name(schema_name, table_name)
+
+            Utils.print_message("...adding serial column " + table_name)
+
+            sql = self._build_sql_to_create_column(table_name, column_name, data_type)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _drop_pk_default_value(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            schema_name = row['table_schema']
+            table_name = row['table_name']
+            table_name = self._build_table_name(schema_name, table_name)
+            column_name = row['column_name']
+
+            Utils.print_message("...dropping PK default value " + table_name + "  " + column_name)
+
+            sql = self._build_sql_to_drop_pk_default_value(table_name, column_name)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_drop_pk_default_value(self, table_name, column_name):
+        sql = 'alter table {table_name} alter column "{column_name}" drop default;'.format(
+            table_name=table_name,
+            column_name=column_name,
+        )
+        return sql
+
+    def _create_temporary_column(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            schema_name = row['table_schema']
+            table_name = row['table_name']
+            column_name = row['column_name']
+            table_name = self._build_table_name(schema_name, table_name)
+            column_name = self._build_temp_column_name(column_name)
+
+            Utils.print_message("...adding " + table_name + "." + column_name)
+
+            sql = self._build_sql_to_create_column(table_name, column_name, 'UUID')
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _drop_temporary_column(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            schema_name = row['table_schema']
+            table_name = row['table_name']
+            column_name = row['column_name']
+
+            table_name = self._build_table_name(schema_name, table_name)
+            column_name = self._build_temp_column_name(column_name)
+
+            Utils.print_message("...dropping temporary column " + table_name + "." + column_name)
+
+            sql = self._build_sql_to_drop_column(table_name, column_name)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+
+class SingleRewriteIdReplacer(IdReplacer):
+    """
+    Perform the ID replace rewriting the heap of each table exactly once.
+
+    The new uuid values are generated into the id mappings (one unlogged table per PK table), or derived from the
+    old ids when the uuid strategy is deterministic, then all column changes of a table are applied by a single
+    "alter table" with combined subcommands:
+    * the PK column is renamed to the serial column (catalog only), keeping the old values;
+    * a new PK column is added as a stored column generated from the serial column (by an immutable copy of the
+      lookup function of the id mapping, dropped with the generation expression);
+    * the PK constraint is moved to the new column;
+    * the FK columns are changed from int / bigint to uuid, computing the uuid of the referenced row.
+    Requires Postgres 13 or later (the generation expression is dropped after the rewrite).
+    """
+
+    def _replace(self, conn, *args, **kwargs):
+        params = kwargs['params']
+        deterministic = self._get_uuid_strategy(params).deterministic
+
+        if params.get('rebuild_indexes'):
+            kwargs['rows'] = self.schema_graph.indexes
+            self._run_phase(conn, "Dropping secondary indexes", self._drop_index, *args, **kwargs)
+
+        if not deterministic:
+            kwargs['rows'] = self.primary_keys
+            self._run_phase(conn, "Creating id mapping tables", self._create_id_mapping, *args, **kwargs)
+            self._run_phase(
+                conn, "Creating pk generation functions", self._create_generation_function, *args, **kwargs
+            )
+
+        # Foreign Key
+        kwargs['rows'] = self.foreign_keys
+        self._run_phase(
+            conn, "Dropping fk constraints", self._drop_fk_constraint, *args, **kwargs, parallel=False
+        )
+
+        kwargs['rows'] = self._build_conversion_plan()
+        self._run_phase(conn, "Rewriting tables", self._rewrite_tables, *args, **kwargs)
+
+        kwargs['rows'] = self.primary_keys
+        self._run_phase(conn, "Dropping pk generation expression", self._drop_pk_expression, *args, **kwargs)
+
+        if not deterministic:
+            self._run_phase(
+                conn, "Dropping pk generation functions", self._drop_generation_function, *args, **kwargs
+            )
+
+        self._run_phase(conn, "Defining a default value to pk", self._add_default_value_to_pk, *args, **kwargs)
+
+        self._recreate_fk_constraints(conn, *args, **kwargs)
+
+        if not deterministic:
+            kwargs['rows'] = self.primary_keys
+            self._run_phase(conn, "Drop id mapping tables", self._drop_id_mapping, *args, **kwargs)
+
+        if params.get('rebuild_indexes'):
+            self._recreate_indexes(conn, *args, **kwargs)
+
+    def _build_mapping_value(self, *args, **kwargs):
+        strategy = self._get_uuid_strategy(kwargs['params'])
+        return strategy.build_value(kwargs['table_name'], '"%s"' % kwargs['column_name'])
+
+    def _build_sql_to_rewrite_table(self, table_name, subcommands):
+        sql = """
+        alter table {table_name}
+        {subcommands};
+        """.format(
+            table_name=table_name,
+            subcommands=',\n        '.join(subcommands),
         )
         return sql
 
-    def _drop_fk_constraint(self, connection, *args, **kwargs):
+    def _build_generation_function_name(self, schema_name, table_name):
+        return '%s.%s_id2uuid_generated' % (schema_name, table_name)
+
+    def _build_sql_to_create_generation_function(self, mapping_table_name, generation_function_name, data_type):
+        sql = self._build_sql_to_create_mapping_function(
+            mapping_table_name, generation_function_name, data_type, volatility='immutable'
+        )
+        sql += 'revoke all on function {generation_function_name}({data_type}) from public;'.format(
+            generation_function_name=generation_function_name,
+            data_type=data_type,
+        )
+        return sql
+
+    def _build_sql_to_drop_generation_function(self, generation_function_name, data_type):
+        sql = 'drop function if exists {generation_function_name}({data_type});'.format(
+            generation_function_name=generation_function_name,
+            data_type=data_type,
+        )
+        return sql
+
+    def _create_generation_function(self, connection, *args, **kwargs):
+        """
+        Create, for each PK table, the function of the generated PK column: the same lookup as the id mapping
+        function, but declared immutable, as Postgres requires for a generation expression. The declaration is
+        false (the result depends on the id mapping table), so the function is only used by the generated columns:
+        it is not executable by public, and it is dropped as soon as the generation expressions are. The foreign
+        keys are converted with the stable lookup function. Do not dump the database between the two phases: the
+        dump would save the generated columns.
+        """
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_schema = row['table_schema']
+            mapping_table_name = self._build_mapping_table_name(table_schema, row['table_name'])
+            generation_function_name = self._build_generation_function_name(table_schema, row['table_name'])
+
+            Utils.print_message("...creating pk generation function " + generation_function_name)
+
+            sql = self._build_sql_to_create_generation_function(
+                mapping_table_name, generation_function_name, row['data_type']
+            )
+            if sql is not None:
+                utils.execute(connection, sql, self._build_table_name(table_schema, row['table_name']))
+
+    def _drop_generation_function(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_schema = row['table_schema']
+            generation_function_name = self._build_generation_function_name(table_schema, row['table_name'])
+
+            Utils.print_message("...dropping pk generation function " + generation_function_name)
+
+            sql = self._build_sql_to_drop_generation_function(generation_function_name, row['data_type'])
+            if sql is not None:
+                utils.execute(connection, sql, self._build_table_name(table_schema, row['table_name']))
+
+    def _build_generation_value(self, row, serial_name, *args, **kwargs):
+        """
+        The generation expression of the new PK column: the deterministic strategy expression, or a call to the
+        (immutable) generation function of the table.
+        """
+        strategy = self._get_uuid_strategy(kwargs['params'])
+        if strategy.deterministic:
+            return strategy.build_value(
+                self._build_table_name(row['table_schema'], row['table_name']), '"%s"' % serial_name
+            )
+        return '%s("%s")' % (
+            self._build_generation_function_name(row['table_schema'], row['table_name']), serial_name
+        )
+
+    def _build_pk_subcommands(self, row, serial_name, *args, **kwargs):
+        value = self._build_generation_value(row, serial_name, *args, **kwargs)
+        return [
+            'drop constraint "{constraint_name}"'.format(constraint_name=row['constraint_name']),
+            'alter column "{serial_name}" drop default'.format(serial_name=serial_name),
+            'alter column "{serial_name}" drop not null'.format(serial_name=serial_name),
+            'add column "{column_name}" uuid generated always as ({value}) stored'.format(
+                column_name=row['column_name'],
+                value=value,
+            ),
+            'add constraint "{constraint_name}" primary key ("{column_name}")'.format(
+                constraint_name=row['constraint_name'],
+                column_name=row['column_name'],
+            ),
+        ]
+
+    def _build_fk_subcommands(self, row, *args, **kwargs):
+        value = self._build_uuid_lookup(
+            row['foreign_table_schema'], row['foreign_table_name'], '"%s"' % row['column_name'], *args, **kwargs
+        )
+        return [
+            'alter column "{column_name}" type uuid using {value}'.format(
+                column_name=row['column_name'],
+                value=value,
+            ),
+        ]
+
+    def _rewrite_tables(self, connection, *args, **kwargs):
+        serial_name = kwargs['params']['serial_name']
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for plan in rows:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            primary_key = plan['primary_key']
+            statements = []
+            subcommands = []
+
+            if primary_key is not None:
+                sql = self._build_sql_to_rename_column(table_name, primary_key['column_name'], serial_name)
+                if sql is not None:
+                    statements.append(sql)
+                subcommands.extend(self._build_pk_subcommands(primary_key, serial_name, *args, **kwargs))
+
+            for row in plan['foreign_keys']:
+                if row['data_type'] == 'uuid':
+                    continue
+                subcommands.extend(self._build_fk_subcommands(row, *args, **kwargs))
+
+            if not subcommands:
+                continue
+
+            Utils.print_message("...rewriting " + table_name)
+
+            sql = self._build_sql_to_rewrite_table(table_name, subcommands)
+            if sql is not None:
+                statements.append(sql)
+            if statements:
+                # the rename can not be a subcommand of the alter: both go in one command string, so they are
+                # committed (or rolled back) together
+                utils.execute(connection, ''.join(statements), table_name)
+
+    def _build_sql_to_drop_expression(self, table_name, column_name):
+        sql = 'alter table {table_name} alter column "{column_name}" drop expression;'.format(
+            table_name=table_name,
+            column_name=column_name,
+        )
+        return sql
+
+    def _drop_pk_expression(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            column_name = row['column_name']
+
+            Utils.print_message("...dropping generation expression " + table_name + "." + column_name)
+
+            sql = self._build_sql_to_drop_expression(table_name, column_name)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+
+class OnlineIdReplacer(IdReplacer):
+    """
+    Perform the ID replace keeping the tables available for writes.
+
+    Shadow uuid columns are added to the PK and FK columns and kept in sync by triggers while the existing rows are
+    backfilled (in batches, when params has a batch_size). Then a short cutover, under a lock_timeout and retried
+    when the locks are not granted, swaps the columns and re-points the constraints. The FK constraints are
+    recreated as "not valid" and validated after the cutover, without blocking the writes.
+
+    The old PK column is kept as the serial column; the old FK columns are dropped, and their indexes are
+    recreated concurrently over the new columns after the cutover. Their unique constraints are moved to indexes
+    built concurrently over the shadow columns before the cutover, their exclusion constraints are recreated by
+    the cutover.
+    The triggers are not disabled by the set_up, since the application keeps writing: the backfill runs with
+    session_replication_role = replica instead, so the triggers of the user (updated_at, audit, etc.) do not fire
+    for the backfilled rows, while the sync triggers, enabled "always", do.
+    """
+
+    def execute(self, *args, **kwargs):
+        params = kwargs.get('params')
+        if params is not None and not params['autocommit']:
+            raise Exception('Online execution requires autocommit')
+        super().execute(*args, **kwargs)
+
+    def set_up(self, connection, *args, **kwargs):
+        pass
+
+    def tear_down(self, connection, *args, **kwargs):
+        pass
+
+    def _replace(self, conn, *args, **kwargs):
+        if self.schema_graph.partitions:
+            raise Exception('OnlineIdReplacer does not support partitioned tables')
+        plans = self._build_conversion_plan()
+        kwargs['constraints'] = self._load_or_record(
+            conn, kwargs['utils'].journal, 'fk_column_constraints',
+            lambda connection: self._get_fk_column_constraints(connection, plans)
+        )
+
+        kwargs['rows'] = self.primary_keys
+        self._run_phase(conn, "Creating shadow pk column", self._create_temporary_column, *args, **kwargs)
+
+        kwargs['rows'] = self.foreign_keys
+        self._run_phase(conn, "Creating shadow fk columns", self._create_shadow_fk_column, *args, **kwargs)
+
+        kwargs['rows'] = plans
+        self._run_phase(conn, "Creating sync triggers", self._create_sync_trigger, *args, **kwargs)
+
+        backfill_settings = {'session_replication_role': 'replica'}
+        kwargs['rows'] = self.primary_keys
+        self._run_phase(
+            conn, "Backfilling shadow pk column", self._backfill_shadow_pk_column, *args, **kwargs,
+            settings=backfill_settings
+        )
+
+        kwargs['rows'] = self.foreign_keys
+        self._run_phase(
+            conn, "Backfilling shadow fk columns", self._backfill_shadow_fk_column, *args, **kwargs,
+            settings=backfill_settings
+        )
+
+        kwargs['rows'] = plans
+        # not pipelined: a chunk would hold the locks of the "add constraint" commands through the validations
+        self._run_phase(conn, "Preparing the cutover", self._prepare_cutover, *args, **kwargs, pipeline=False)
+
+        self._run_phase(conn, "Cutover", self._cutover, *args, **kwargs, parallel=False, pipeline=False)
+
+        kwargs['rows'] = self.foreign_keys
+        self._run_phase(conn, "Validating fk constraints", self._validate_fk_constraint, *args, **kwargs)
+
+        kwargs['rows'] = self._get_fk_indexes()
+        self._run_phase(
+            conn, "Recreating indexes of the fk columns", self._create_index, *args, **kwargs, concurrently=True,
+            group_by_table=False, settings=self._get_index_settings(kwargs['params'])
+        )
+
+    def _get_fk_indexes(self):
+        """
+        The secondary indexes over FK columns: they are dropped with the old FK columns in the cutover.
+        """
+        rows = []
+        for index in self.schema_graph.indexes:
+            table = self.schema_graph.get_table(index['table_schema'], index['table_name'])
+            fk_columns = set(row['column_name'] for row in table['foreign_keys'])
+            if set(index['column_names']) & fk_columns:
+                rows.append(index)
+        return rows
+
+    def _get_fk_column_constraints(self, connection, plans):
+        """
+        The unique and exclusion constraints over the FK columns: they are dropped with the old FK columns in the
+        cutover.
+        :return: a list of dicts with table_schema, table_name, constraint_name, constraint_type (u or x),
+        definition, column_names and deferrable.
+        """
+        fk_columns = dict(
+            (self._build_table_name(plan['table_schema'], plan['table_name']),
+             set(row['column_name'] for row in plan['foreign_keys']))
+            for plan in plans if plan['foreign_keys']
+        )
+        if not fk_columns:
+            return []
+        sql = """
+        select
+          n.nspname as table_schema, t.relname as table_name, c.conname as constraint_name,
+          c.contype as constraint_type, pg_get_constraintdef(c.oid) as definition,
+          array(
+            select a.attname::text from unnest(c.conkey) with ordinality as k(attnum, position)
+            inner join pg_attribute a on a.attrelid = c.conrelid and a.attnum = k.attnum
+            order by k.position
+          ) as column_names,
+          case when c.condeferrable then
+            'deferrable initially ' || case when c.condeferred then 'deferred' else 'immediate' end
+          end as deferrable
+        from pg_constraint c
+        inner join pg_class t on t.oid = c.conrelid
+        inner join pg_namespace n on n.oid = t.relnamespace
+        where c.contype in ('u', 'x')
+        and c.conrelid = any(array[{tables}]::regclass[]);
+        """.format(
+            tables=', '.join("'%s'" % table_name for table_name in fk_columns),
+        )
+        rows = DatabaseUtils().select(connection, sql)
+        return [
+            dict(row) for row in rows
+            if set(row['column_names']) & fk_columns[self._build_table_name(row['table_schema'], row['table_name'])]
+        ]
+
+    def _get_table_constraints(self, plan, constraints):
+        return [
+            row for row in constraints
+            if (row['table_schema'], row['table_name']) == (plan['table_schema'], plan['table_name'])
+        ]
+
+    def _build_sql_to_create_unique_shadow_index(self, table_name, index_name, column_names):
+        sql = 'create unique index concurrently if not exists "{index_name}" on {table_name} ({columns});'.format(
+            table_name=table_name,
+            index_name=index_name,
+            columns=', '.join('"%s"' % column_name for column_name in column_names),
+        )
+        return sql
+
+    def _build_sql_to_add_unique_constraint_using_index(self, table_name, constraint_name, index_name, deferrable):
+        sql = """
+        alter table {table_name} add constraint "{constraint_name}" unique using index "{index_name}"{deferrable};
+        """.format(
+            table_name=table_name,
+            constraint_name=constraint_name,
+            index_name=index_name,
+            deferrable='' if deferrable is None else ' ' + deferrable,
+        )
+        return sql
+
+    def _build_sql_to_add_table_constraint(self, table_name, constraint_name, definition):
+        sql = 'alter table {table_name} add constraint "{constraint_name}" {definition};'.format(
+            table_name=table_name,
+            constraint_name=constraint_name,
+            definition=definition,
+        )
+        return sql
+
+    def _build_shadow_column_names(self, plan, column_names):
+        """
+        The columns of a constraint with the FK columns replaced by their shadow columns.
+        """
+        fk_columns = set(row['column_name'] for row in plan['foreign_keys'])
+        return [
+            self._build_temp_column_name(column_name) if column_name in fk_columns else column_name
+            for column_name in column_names
+        ]
+
+    def _build_sync_trigger_name(self, table_name):
+        return '%s_sync2replace' % table_name
+
+    def _build_check_constraint_name(self, column_name):
+        return '%s_check2replace' % column_name
+
+    def _build_index_name(self, table_name, column_name):
+        return '%s_%s_idx2replace' % (table_name, column_name)
+
+    def _create_shadow_fk_column(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            column_name = self._build_temp_column_name(row['column_name'])
+
+            Utils.print_message("...adding " + table_name + "." + column_name)
+
+            sql = self._build_sql_to_create_column(table_name, column_name, 'UUID')
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_create_sync_trigger(self, table_name, function_name, trigger_name, assignments):
+        sql = """
+        create or replace function {function_name}() returns trigger language plpgsql as $$
+        begin
+        {assignments}
+        return new;
+        end $$;
+        drop trigger if exists "{trigger_name}" on {table_name};
+        create trigger "{trigger_name}" before insert or update on {table_name}
+        for each row execute procedure {function_name}();
+        alter table {table_name} enable always trigger "{trigger_name}";
+        """.format(
+            table_name=table_name,
+            function_name=function_name,
+            trigger_name=trigger_name,
+            assignments='\n        '.join(assignments),
+        )
+        return sql
+
+    def _build_sync_assignments(self, plan, *args, **kwargs):
+        """
+        The plpgsql statements that fill the shadow columns of a new (or updated) row.
+        """
+        assignments = []
+        primary_key = plan['primary_key']
+        if primary_key is not None:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            column_name = primary_key['column_name']
+            temp_name = self._build_temp_column_name(column_name)
+            value = self._get_uuid_strategy(kwargs['params']).build_value(table_name, 'new."%s"' % column_name)
+            assignments.append(
+                'if new."{temp_name}" is null then new."{temp_name}" := {value}; end if;'.format(
+                    temp_name=temp_name,
+                    value=value,
+                )
+            )
+        for row in plan['foreign_keys']:
+            assignments.append(
+                'new."{temp_name}" := (select x."{foreign_temp_name}" from {foreign_table_name} x '
+                'where x."{foreign_column_name}" = new."{column_name}");'.format(
+                    temp_name=self._build_temp_column_name(row['column_name']),
+                    foreign_temp_name=self._build_temp_column_name(row['foreign_column_name']),
+                    foreign_table_name=self._build_table_name(row['foreign_table_schema'], row['foreign_table_name']),
+                    foreign_column_name=row['foreign_column_name'],
+                    column_name=row['column_name'],
+                )
+            )
+        return assignments
+
+    def _create_sync_trigger(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for plan in rows:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            trigger_name = self._build_sync_trigger_name(plan['table_name'])
+            function_name = self._build_table_name(plan['table_schema'], trigger_name)
+
+            Utils.print_message("...creating sync trigger " + table_name)
+
+            assignments = self._build_sync_assignments(plan, *args, **kwargs)
+            sql = self._build_sql_to_create_sync_trigger(table_name, function_name, trigger_name, assignments)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_backfill_column(self, table_name, column_name, value, condition=None):
+        sql = 'update {table_name} set "{column_name}" = {value} where "{column_name}" is null{condition};'.format(
+            table_name=table_name,
+            column_name=column_name,
+            value=value,
+            condition='' if condition is None else ' and ' + condition,
+        )
+        return sql
+
+    def _backfill_shadow_pk_column(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        strategy = self._get_uuid_strategy(kwargs['params'])
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            column_name = row['column_name']
+            temp_name = self._build_temp_column_name(column_name)
+            value = strategy.build_value(table_name, '"%s"' % column_name)
+
+            Utils.print_message("...backfilling " + table_name + "." + temp_name)
+
+            def build_sql(condition, table_name=table_name, temp_name=temp_name, value=value):
+                return self._build_sql_to_backfill_column(table_name, temp_name, value, condition)
+
+            self._execute_update(connection, utils, table_name, build_sql, column_name, kwargs['params'])
+
+    def _build_sql_to_backfill_fk_column(
+            self, table_name, column_name, temp_name, foreign_table_name, foreign_column_name, foreign_temp_name,
+            condition=None
+    ):
+        sql = """
+        update {table_name} a
+        set "{temp_name}" = x."{foreign_temp_name}"
+        from {foreign_table_name} x
+        where a."{column_name}" = x."{foreign_column_name}" and a."{temp_name}" is null{condition};
+        """.format(
+            table_name=table_name,
+            column_name=column_name,
+            temp_name=temp_name,
+            foreign_table_name=foreign_table_name,
+            foreign_column_name=foreign_column_name,
+            foreign_temp_name=foreign_temp_name,
+            condition='' if condition is None else ' and ' + condition,
+        )
+        return sql
+
+    def _backfill_shadow_fk_column(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
+        for row in rows:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            column_name = row['column_name']
+            temp_name = self._build_temp_column_name(column_name)
+            foreign_table_name = self._build_table_name(row['foreign_table_schema'], row['foreign_table_name'])
+            foreign_column_name = row['foreign_column_name']
+            foreign_temp_name = self._build_temp_column_name(foreign_column_name)
+
+            Utils.print_message("...backfilling " + table_name + "." + temp_name)
+
+            def build_sql(
+                    condition, table_name=table_name, column_name=column_name, temp_name=temp_name,
+                    foreign_table_name=foreign_table_name, foreign_column_name=foreign_column_name,
+                    foreign_temp_name=foreign_temp_name
+            ):
+                return self._build_sql_to_backfill_fk_column(
+                    table_name, column_name, temp_name, foreign_table_name, foreign_column_name, foreign_temp_name,
+                    condition
+                )
+
+            self._execute_update(
+                connection, utils, table_name, build_sql, self._get_primary_key_name(row), kwargs['params'], alias='a'
+            )
+
+    def _build_sql_to_drop_check_constraint(self, table_name, constraint_name):
+        sql = 'alter table {table_name} drop constraint if exists "{constraint_name}";'.format(
+            table_name=table_name,
+            constraint_name=constraint_name,
+        )
+        return sql
+
+    def _build_sql_to_add_check_constraint(self, table_name, constraint_name, condition):
+        sql = 'alter table {table_name} add constraint "{constraint_name}" check ({condition}) not valid;'.format(
+            table_name=table_name,
+            constraint_name=constraint_name,
+            condition=condition,
+        )
+        return sql
+
+    def _build_sql_to_validate_check_constraint(self, table_name, constraint_name):
+        sql = 'alter table {table_name} validate constraint "{constraint_name}";'.format(
+            table_name=table_name,
+            constraint_name=constraint_name,
+        )
+        return sql
+
+    def _add_check_constraint(self, connection, utils, table_name, constraint_name, condition):
+        """
+        Add a check constraint as "not valid" and validate it, each command in its own transaction: the validation
+        scans the table holding a lock that lets the writes go on, the short ACCESS EXCLUSIVE lock of the "add" is
+        released before it.
+        """
+        for sql in [
+            self._build_sql_to_drop_check_constraint(table_name, constraint_name),
+            self._build_sql_to_add_check_constraint(table_name, constraint_name, condition),
+            self._build_sql_to_validate_check_constraint(table_name, constraint_name),
+        ]:
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
+
+    def _build_sql_to_create_unique_index(self, table_name, index_name, column_name):
+        sql = 'create unique index concurrently if not exists "{index_name}" on {table_name} ("{column_name}");'.format(
+            table_name=table_name,
+            index_name=index_name,
+            column_name=column_name,
+        )
+        return sql
+
+    def _prepare_cutover(self, connection, *args, **kwargs):
+        """
+        Build, without blocking the writes, what makes the cutover instantaneous: the unique index of the new PK, the
+        unique indexes of the unique constraints over the FK columns and validated check constraints proving that
+        every shadow column is filled.
+        """
         rows = kwargs['rows']
         utils = kwargs['utils']
-        for row in rows:
-            schema_name = row['table_schema']
-            table_name = row['table_name']
-            table_name = self._build_table_name(schema_name, table_name)
-            constraint_name = row['constraint_name']
+        for plan in rows:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+
+            Utils.print_message("...preparing the cutover of " + table_name)
+
+            primary_key = plan['primary_key']
+            if primary_key is not None:
+                temp_name = self._build_temp_column_name(primary_key['column_name'])
+                index_name = self._build_index_name(plan['table_name'], temp_name)
+                sql = self._build_sql_to_create_unique_index(table_name, index_name, temp_name)
+                if sql is not None:
+                    utils.execute(connection, sql, table_name)
+                condition = '"%s" is not null' % temp_name
+                self._add_check_constraint(
+                    connection, utils, table_name, self._build_check_constraint_name(temp_name), condition
+                )
+
+            for row in self._get_table_constraints(plan, kwargs['constraints']):
+                if row['constraint_type'] != 'u':
+                    continue
+                sql = self._build_sql_to_create_unique_shadow_index(
+                    table_name, self._build_index_name(plan['table_name'], row['constraint_name']),
+                    self._build_shadow_column_names(plan, row['column_names'])
+                )
+                if sql is not None:
+                    utils.execute(connection, sql, table_name)
+
+            for row in plan['foreign_keys']:
+                temp_name = self._build_temp_column_name(row['column_name'])
+                condition = '("{column_name}" is null) = ("{temp_name}" is null)'.format(
+                    column_name=row['column_name'],
+                    temp_name=temp_name,
+                )
+                self._add_check_constraint(
+                    connection, utils, table_name, self._build_check_constraint_name(temp_name), condition
+                )
+
+    def _build_cutover_commands(self, plans, *args, **kwargs):
+        """
+        The commands of the cutover transaction, in order.
+        """
+        params = kwargs['params']
+        serial_name = params['serial_name']
+        default_value = self._get_uuid_strategy(params).build_default()
+        commands = [
+            'set local lock_timeout = \'%s\';' % params.get('lock_timeout', '5s'),
+            'lock table %s in access exclusive mode;' % ', '.join(
+                self._build_table_name(plan['table_schema'], plan['table_name']) for plan in plans
+            ),
+        ]
+        for plan in plans:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            trigger_name = self._build_sync_trigger_name(plan['table_name'])
+            function_name = self._build_table_name(plan['table_schema'], trigger_name)
+            commands.append('drop trigger if exists "%s" on %s;' % (trigger_name, table_name))
+            commands.append('drop function if exists %s();' % function_name)
+        for row in self.foreign_keys:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            commands.append(self._build_sql_to_drop_constraint(table_name, row['constraint_name']))
+        for plan in plans:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            primary_key = plan['primary_key']
+            if primary_key is not None:
+                column_name = primary_key['column_name']
+                temp_name = self._build_temp_column_name(column_name)
+                constraint_name = primary_key['constraint_name']
+                commands.extend([
+                    self._build_sql_to_drop_constraint(table_name, constraint_name),
+                    self._build_sql_to_drop_pk_default_value(table_name, column_name),
+                    'alter table {table_name} alter column "{column_name}" drop not null;'.format(
+                        table_name=table_name,
+                        column_name=column_name,
+                    ),
+                    self._build_sql_to_rename_column(table_name, column_name, serial_name),
+                    self._build_sql_to_rename_column(table_name, temp_name, column_name),
+                    'alter table {table_name} add constraint "{constraint_name}" primary key '
+                    'using index "{index_name}";'.format(
+                        table_name=table_name,
+                        constraint_name=constraint_name,
+                        index_name=self._build_index_name(plan['table_name'], temp_name),
+                    ),
+                    self._build_sql_to_drop_constraint(table_name, self._build_check_constraint_name(temp_name)),
+                    self._build_sql_to_add_default_value(table_name, column_name, default_value),
+                ])
+            for row in plan['foreign_keys']:
+                column_name = row['column_name']
+                temp_name = self._build_temp_column_name(column_name)
+                commands.extend([
+                    self._build_sql_to_drop_constraint(table_name, self._build_check_constraint_name(temp_name)),
+                    self._build_sql_to_drop_column(table_name, column_name),
+                    self._build_sql_to_rename_column(table_name, temp_name, column_name),
+                ])
+            for row in self._get_table_constraints(plan, kwargs['constraints']):
+                # dropped with the old FK columns: the unique ones take the indexes built before the cutover
+                if row['constraint_type'] == 'u':
+                    commands.append(self._build_sql_to_add_unique_constraint_using_index(
+                        table_name, row['constraint_name'],
+                        self._build_index_name(plan['table_name'], row['constraint_name']), row['deferrable']
+                    ))
+                else:
+                    commands.append(self._build_sql_to_add_table_constraint(
+                        table_name, row['constraint_name'], row['definition']
+                    ))
+        for row in self.foreign_keys:
+            commands.append(self._build_sql_to_create_constraint(
+                self._build_table_name(row['table_schema'], row['table_name']),
+                row['constraint_name'],
+                row['column_name'],
+                self._build_table_name(row['foreign_table_schema'], row['foreign_table_name']),
+                row['foreign_column_name'],
+                row['match_option'],
+                row['update_rule'],
+                row['delete_rule'],
+                not_valid=True,
+            ))
+        return commands
+
+    def _cutover(self, conn, *args, **kwargs):
+        """
+        Swap the columns in a single short transaction. When the locks are not granted within the lock_timeout,
+        the transaction is rolled back and retried (params cutover_retries and cutover_pause).
+        """
+        params = kwargs['params']
+        utils = kwargs['utils']
+        retries = params.get('cutover_retries', 10)
+        commands = self._build_cutover_commands(self._build_conversion_plan(), *args, **kwargs)
+        connection = utils.get_connection(dict(params, autocommit=False))
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    with connection:
+                        for sql in commands:
+                            utils.execute(connection, sql)
+                    return
+                except psycopg2.OperationalError as e:
+                    if e.pgcode != errorcodes.LOCK_NOT_AVAILABLE or attempt > retries:
+                        raise
+                    Utils.print_message("...locks not granted, retrying the cutover (%d/%d)" % (attempt, retries))
+                    time.sleep(params.get('cutover_pause', 5))
+        finally:
+            connection.close()
 
-            Utils.print_message("...dropping FK constraint " + table_name + " " + constraint_name)
 
-            sql = self._build_sql_to_drop_constraint(table_name, constraint_name)
-            if sql is not None:
-                utils.execute(connection, sql)
+class RebuildIdReplacer(IdReplacer):
+    """
+    Perform the ID replace copying each table into a new one and swapping their names.
 
-    def _create_fk_constraint(self, connection, *args, **kwargs):
-        rows = kwargs['rows']
+    Each table is copied by a single "insert ... select" into a new table (created "like" the old one, with uuid
+    columns), computing the new PK and FK values from the id mappings (or from a deterministic uuid strategy). The
+    old PK values go to the serial column. The names are swapped, the old tables are dropped and the constraints,
+    indexes and triggers are recreated, leaving compact tables and indexes, without dead rows. Each table is
+    locked against the writes (not the reads) from the start of its copy to the swap, in a single transaction.
+
+    Grants, row level security policies and publications are not copied; views over the tables must be dropped by
+    the set_up and recreated by the tear_down. Partitioned tables are not supported.
+    """
+
+    def _replace(self, conn, *args, **kwargs):
+        params = kwargs['params']
         utils = kwargs['utils']
-        for row in rows:
-            table_name = self._build_table_name(row['table_schema'], row['table_name'])
-            constraint_name = row['constraint_name']
-            column_name = row['column_name']
-            foreign_table_name = self._build_table_name(row['foreign_table_schema'], row['foreign_table_name'])
-            foreign_column_name = row['foreign_column_name']
-            match_option = row['match_option']
-            update_rule = row['update_rule']
-            delete_rule = row['delete_rule']
+        deterministic = self._get_uuid_strategy(params).deterministic
+        plans = self._build_conversion_plan()
+        definitions = self._load_or_record(
+            conn, utils.journal, 'table_definitions', lambda connection: self._get_table_definitions(connection, plans)
+        )
+        other_foreign_keys = self._load_or_record(
+            conn, utils.journal, 'other_foreign_keys',
+            lambda connection: self._get_other_foreign_keys(connection, plans)
+        )
 
-            Utils.print_message("...creating FK constraints " + table_name + " " + constraint_name)
+        if not deterministic:
+            kwargs['rows'] = self.primary_keys
+            self._run_phase(conn, "Creating id mapping tables", self._create_id_mapping, *args, **kwargs)
 
-            sql = self._build_sql_to_create_constraint(
-                table_name, constraint_name, column_name, foreign_table_name, foreign_column_name,
-                match_option, update_rule, delete_rule
+        kwargs['rows'] = self.foreign_keys
+        self._run_phase(
+            conn, "Dropping fk constraints", self._drop_fk_constraint, *args, **kwargs, parallel=False
+        )
+
+        kwargs['rows'] = other_foreign_keys
+        self._run_phase(
+            conn, "Dropping other fk constraints", self._drop_fk_constraint, *args, **kwargs, parallel=False
+        )
+
+        kwargs['rows'] = plans
+        self._run_phase(
+            conn, "Rebuilding tables", self._rebuild_tables, *args, **kwargs, definitions=definitions
+        )
+
+        self._run_phase(conn, "Dropping old tables", self._drop_old_tables, *args, **kwargs)
+
+        self._run_phase(
+            conn, "Recreating constraints, indexes and triggers", self._recreate_table_objects, *args, **kwargs,
+            definitions=definitions
+        )
+
+        self._recreate_fk_constraints(conn, *args, **kwargs)
+
+        kwargs['rows'] = other_foreign_keys
+        self._run_phase(
+            conn, "Recreating other fk constraints", self._recreate_other_fk_constraint, *args, **kwargs,
+            parallel=False
+        )
+
+        if not deterministic:
+            kwargs['rows'] = self.primary_keys
+            self._run_phase(conn, "Drop id mapping tables", self._drop_id_mapping, *args, **kwargs)
+
+    def _build_mapping_value(self, *args, **kwargs):
+        strategy = self._get_uuid_strategy(kwargs['params'])
+        return strategy.build_value(kwargs['table_name'], '"%s"' % kwargs['column_name'])
+
+    def _build_new_table_name(self, table_name):
+        return '%s_new2replace' % table_name
+
+    def _is_copy(self, sql):
+        sql = ' '.join(sql.lower().split())
+        return re.search(r'\binsert into \S+%s \(' % re.escape(self._build_new_table_name('')), sql) is not None
+
+    def _build_old_table_name(self, table_name):
+        return '%s_old2replace' % table_name
+
+    def _get_table_definitions(self, connection, plans):
+        """
+        Read what is needed to rebuild each table: columns, relation kind, owned sequences (of serial columns),
+        identity columns, constraints (PK, unique, exclusion), secondary indexes and triggers.
+        :return: a dict schema.table => definition.
+        """
+        definitions = {}
+        for plan in plans:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            sql = """
+            select
+              c.relkind,
+              array(
+                select a.attname::text from pg_attribute a
+                where a.attrelid = c.oid and a.attnum > 0 and not a.attisdropped and a.attgenerated = ''
+                order by a.attnum
+              ) as columns,
+              array(
+                select pg_get_constraintdef(k.oid) || '|' || k.conname from pg_constraint k
+                where k.conrelid = c.oid and k.contype in ('p', 'u', 'x')
+              ) as constraints,
+              array(
+                select pg_get_indexdef(x.indexrelid) from pg_index x
+                where x.indrelid = c.oid
+                and not exists (select 1 from pg_constraint k where k.conindid = x.indexrelid and k.conrelid = c.oid)
+              ) as indexes,
+              array(
+                select pg_get_triggerdef(t.oid) from pg_trigger t where t.tgrelid = c.oid and not t.tgisinternal
+              ) as triggers,
+              array(
+                select quote_ident(sn.nspname) || '.' || quote_ident(s.relname) || '|' || a.attname
+                from pg_depend d
+                inner join pg_class s on s.oid = d.objid and s.relkind = 'S'
+                inner join pg_namespace sn on sn.oid = s.relnamespace
+                inner join pg_attribute a on a.attrelid = d.refobjid and a.attnum = d.refobjsubid
+                where d.refobjid = c.oid and d.classid = 'pg_class'::regclass and d.deptype = 'a'
+              ) as sequences,
+              array(
+                select a.attname::text from pg_attribute a
+                where a.attrelid = c.oid and a.attnum > 0 and not a.attisdropped and a.attidentity <> ''
+              ) as identities
+            from pg_class c
+            where c.oid = '{table_name}'::regclass;
+            """.format(
+                table_name=table_name,
             )
-            if sql is not None:
-                utils.execute(connection, sql)
+            row = DatabaseUtils().select(connection, sql)[0]
+            if row['relkind'] != 'r':
+                raise Exception('RebuildIdReplacer does not support the table %s (relkind %s)' % (
+                    table_name, row['relkind']
+                ))
+            definitions[table_name] = {
+                'columns': row['columns'],
+                'constraints': [
+                    {'definition': value.rsplit('|', 1)[0], 'constraint_name': value.rsplit('|', 1)[1]}
+                    for value in row['constraints']
+                ],
+                'indexes': row['indexes'],
+                'triggers': row['triggers'],
+                'sequences': [
+                    {'sequence_name': value.split('|', 1)[0], 'column_name': value.split('|', 1)[1]}
+                    for value in row['sequences']
+                ],
+                'identities': row['identities'],
+            }
+        return definitions
+
+    def _get_other_foreign_keys(self, connection, plans):
+        """
+        The FK constraints from or to the rebuilt tables that are not converted (not integer): they would be lost
+        with the old tables, so they are dropped before the rebuild and recreated after it.
+        """
+        if not plans:
+            return []
+        sql = """
+        select n.nspname as table_schema, t.relname as table_name, c.conname as constraint_name,
+          pg_get_constraintdef(c.oid) as definition
+        from pg_constraint c
+        inner join pg_class t on t.oid = c.conrelid
+        inner join pg_namespace n on n.oid = t.relnamespace
+        where c.contype = 'f'
+        and (c.conrelid = any(array[{tables}]::regclass[]) or c.confrelid = any(array[{tables}]::regclass[]));
+        """.format(
+            tables=', '.join(
+                "'%s'" % self._build_table_name(plan['table_schema'], plan['table_name']) for plan in plans
+            ),
+        )
+        converted = set((row['table_schema'], row['table_name'], row['constraint_name']) for row in self.foreign_keys)
+        rows = DatabaseUtils().select(connection, sql)
+        return [
+            dict(row) for row in rows
+            if (row['table_schema'], row['table_name'], row['constraint_name']) not in converted
+        ]
+
+    def _build_sql_to_create_new_table(self, table_name, new_table_name):
+        sql = """
+        drop table if exists {new_table_name};
+        create table {new_table_name} (
+          like {table_name} including defaults including generated including identity including storage
+          including comments including constraints
+        );
+        """.format(
+            table_name=table_name,
+            new_table_name=new_table_name,
+        )
+        return sql
+
+    def _build_new_table_subcommands(self, plan, serial_name, *args, **kwargs):
+        """
+        The changes of the (empty) new table: uuid PK and FK columns, and the serial column.
+        """
+        subcommands = []
+        primary_key = plan['primary_key']
+        if primary_key is not None:
+            default_value = self._get_uuid_strategy(kwargs['params']).build_default()
+            subcommands.extend([
+                # the default of an identity column can not be dropped: the identity goes first
+                'alter column "{column_name}" drop identity if exists'.format(column_name=primary_key['column_name']),
+                'alter column "{column_name}" drop default'.format(column_name=primary_key['column_name']),
+                'alter column "{column_name}" type uuid using null'.format(column_name=primary_key['column_name']),
+                'alter column "{column_name}" set default {value}'.format(
+                    column_name=primary_key['column_name'],
+                    value=default_value,
+                ),
+                'add column "{serial_name}" {data_type}'.format(
+                    serial_name=serial_name,
+                    data_type=primary_key['data_type'],
+                ),
+            ])
+        for row in plan['foreign_keys']:
+            if row['data_type'] == 'uuid':
+                continue
+            subcommands.append('alter column "{column_name}" type uuid using null'.format(
+                column_name=row['column_name'],
+            ))
+        return subcommands
+
+    def _build_sql_to_lock_table(self, table_name):
+        """
+        Block the writes (not the reads) on the old table until the new one takes its place.
+        """
+        sql = 'lock table {table_name} in exclusive mode;'.format(table_name=table_name)
+        return sql
+
+    def _build_sql_to_copy_table(self, table_name, new_table_name, columns, values):
+        sql = """
+        insert into {new_table_name} ({columns}) overriding system value
+        select {values} from {table_name};
+        analyze {new_table_name};
+        """.format(
+            table_name=table_name,
+            new_table_name=new_table_name,
+            columns=', '.join(columns),
+            values=', '.join(values),
+        )
+        return sql
+
+    def _build_copy_values(self, plan, columns, serial_name, *args, **kwargs):
+        """
+        The columns of the new table and the expressions that fill them from the old one.
+        """
+        primary_key = plan['primary_key']
+        foreign_keys = dict((row['column_name'], row) for row in plan['foreign_keys'] if row['data_type'] != 'uuid')
+        names = []
+        values = []
+        for column_name in columns:
+            column_sql = '"%s"' % column_name
+            names.append(column_sql)
+            if primary_key is not None and column_name == primary_key['column_name']:
+                values.append(self._build_uuid_lookup(
+                    plan['table_schema'], plan['table_name'], column_sql, *args, **kwargs
+                ))
+            elif column_name in foreign_keys:
+                row = foreign_keys[column_name]
+                values.append(self._build_uuid_lookup(
+                    row['foreign_table_schema'], row['foreign_table_name'], column_sql, *args, **kwargs
+                ))
+            else:
+                values.append(column_sql)
+        if primary_key is not None:
+            names.append('"%s"' % serial_name)
+            values.append('"%s"' % primary_key['column_name'])
+        return names, values
 
-    def _build_sql_to_update_column(self, table_name, column_name, value):
-        sql = 'update {table_name} set "{column_name}" = {value};'.format(
+    def _build_sql_to_restart_identity(self, table_name, column_name):
+        """
+        The identity of the new table, created "like" the old one, starts at 1: it continues after the copied rows.
+        """
+        sql = """
+        select setval(
+          pg_get_serial_sequence('{table_name}', '{column_name}'), coalesce(max("{column_name}"), 0) + 1, false
+        ) from {table_name};
+        """.format(
             table_name=table_name,
             column_name=column_name,
-            value=value,
         )
         return sql
 
-    def _copy_pk_column_to_serial_column(self, connection, *args, **kwargs):
+    def _build_sql_to_swap_tables(self, plan, definition, serial_name):
+        """
+        Rename the old table out of the way and the new table to the original name, moving the ownership of the
+        sequences of the serial columns (the sequence of the PK goes to the serial column). The identity sequences
+        are left with their tables. Sent as a single command, so it is atomic.
+        """
+        table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+        primary_key = plan['primary_key']
+        commands = []
+        for sequence in definition['sequences']:
+            commands.append('alter sequence %s owned by none;' % sequence['sequence_name'])
+        commands.append('alter table %s rename to "%s";' % (table_name, self._build_old_table_name(plan['table_name'])))
+        commands.append('alter table %s rename to "%s";' % (
+            self._build_new_table_name(table_name), plan['table_name']
+        ))
+        for sequence in definition['sequences']:
+            column_name = sequence['column_name']
+            if primary_key is not None and column_name == primary_key['column_name']:
+                column_name = serial_name
+            commands.append('alter sequence %s owned by %s."%s";' % (
+                sequence['sequence_name'], table_name, column_name
+            ))
+        return '\n'.join(commands)
+
+    def _rebuild_tables(self, connection, *args, **kwargs):
         serial_name = kwargs['params']['serial_name']
+        definitions = kwargs['definitions']
         rows = kwargs['rows']
         utils = kwargs['utils']
+        for plan in rows:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            new_table_name = self._build_new_table_name(table_name)
+            definition = definitions[table_name]
 
-        for row in rows:
-            table_schema = row['table_schema']
-            table_name = self._build_table_name(table_schema, row['table_name'])
-            column_name = row['column_name']
+            Utils.print_message("...rebuilding " + table_name)
 
-            Utils.print_message("...copying pk to serial column " + table_name)
+            sql = self._build_sql_to_create_new_table(table_name, new_table_name)
+            if sql is not None:
+                utils.execute(connection, sql, table_name)
 
-            sql = self._build_sql_to_update_column(table_name, serial_name, column_name)
+            subcommands = self._build_new_table_subcommands(plan, serial_name, *args, **kwargs)
+            sql = 'alter table %s %s;' % (new_table_name, ', '.join(subcommands))
+            utils.execute(connection, sql, table_name)
+
+            # the copy and the swap are sent as one command (one transaction), the old table locked against the
+            # writes: the rows written during the copy would be lost with the old table
+            statements = []
+            sql = self._build_sql_to_lock_table(table_name)
             if sql is not None:
-                utils.execute(connection, sql)
+                statements.append(sql)
 
-    def _build_primary_key_update_command(self, *args, **kwargs):
-        return kwargs['update_command'].format(value='gen_random_uuid()')
+            columns, values = self._build_copy_values(plan, definition['columns'], serial_name, *args, **kwargs)
+            sql = self._build_sql_to_copy_table(table_name, new_table_name, columns, values)
+            if sql is not None:
+                statements.append(sql)
 
-    def _copy_temporary_column_to_pk(self, connection, *args, **kwargs):
+            for column_name in definition.get('identities', []):
+                if plan['primary_key'] is not None and column_name == plan['primary_key']['column_name']:
+                    continue
+                sql = self._build_sql_to_restart_identity(new_table_name, column_name)
+                if sql is not None:
+                    statements.append(sql)
+
+            sql = self._build_sql_to_swap_tables(plan, definition, serial_name)
+            if sql is not None:
+                statements.append(sql)
+            if statements:
+                utils.execute(connection, '\n'.join(statements), table_name)
+
+    def _drop_old_tables(self, connection, *args, **kwargs):
         rows = kwargs['rows']
         utils = kwargs['utils']
+        for plan in rows:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            old_table_name = self._build_table_name(
+                plan['table_schema'], self._build_old_table_name(plan['table_name'])
+            )
 
-        for row in rows:
-            table_name = self._build_table_name(row['table_schema'], row['table_name'])
-            column_name = row['column_name']
-            temp_column = self._build_temp_column_name(column_name)
-
-            Utils.print_message("...copying temporary column to PK " + table_name + "." + column_name)
+            Utils.print_message("...dropping " + old_table_name)
 
-            sql = self._build_sql_to_update_column(table_name, column_name, temp_column)
-            if sql is not None:
-                utils.execute(connection, sql)
+            sql = 'drop table if exists %s;' % old_table_name
+            utils.execute(connection, sql, table_name)
 
-    def _assign_value_to_temporary_pk_column(self, connection, *args, **kwargs):
+    def _recreate_table_objects(self, connection, *args, **kwargs):
+        definitions = kwargs['definitions']
         rows = kwargs['rows']
         utils = kwargs['utils']
+        for plan in rows:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            definition = definitions[table_name]
+
+            Utils.print_message("...recreating constraints, indexes and triggers of " + table_name)
+
+            for constraint in definition['constraints']:
+                sql = 'alter table {table_name} add constraint "{constraint_name}" {definition};'.format(
+                    table_name=table_name,
+                    constraint_name=constraint['constraint_name'],
+                    definition=constraint['definition'],
+                )
+                utils.execute(connection, sql, table_name)
+            for index in definition['indexes']:
+                sql = self._build_sql_to_create_index(index)
+                utils.execute(connection, sql, table_name)
+            for trigger in definition['triggers']:
+                utils.execute(connection, trigger + ';', table_name)
 
+    def _recreate_other_fk_constraint(self, connection, *args, **kwargs):
+        rows = kwargs['rows']
+        utils = kwargs['utils']
         for row in rows:
-            data_type = row['data_type']
-            table_schema = row['table_schema']
-            table_name = self._build_table_name(table_schema, row['table_name'])
-            column_name = self._build_temp_column_name(row['column_name'])
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
 
-            Utils.print_message("...assiging " + table_name + "." + column_name)
+            Utils.print_message("...creating FK constraints " + table_name + " " + row['constraint_name'])
 
-            update_command = self._build_sql_to_update_column(table_name, column_name, '{value}')
-            update_command = self._build_primary_key_update_command(
-                *args,
-                **kwargs,
-                connection=connection,
-                table_schema=table_schema,
+            sql = 'alter table {table_name} add constraint "{constraint_name}" {definition};'.format(
                 table_name=table_name,
-                column_name=column_name,
-                data_type=data_type,
-                update_command=update_command,
+                constraint_name=row['constraint_name'],
+                definition=row['definition'],
             )
-            if update_command is not None:
-                utils.execute(connection, update_command)
+            utils.execute(connection, sql, table_name)
 
-    def _get_primary_keys(self, connection):
-        sql = """
-        select distinct tc.table_schema, tc.table_name, kcu.column_name, c.data_type
-        from information_schema.table_constraints as tc
-        inner join information_schema.key_column_usage kcu on tc.constraint_name = kcu.constraint_name
-        inner join information_schema.columns c on tc.table_schema = c.table_schema and tc.table_name = c.table_name and kcu.column_name = c.column_name
-        where constraint_type = 'PRIMARY KEY'
-        and data_type in ('integer', 'bigint')
-        and tc.table_schema not in ('pg_catalog');
-        """
-        rows = DatabaseUtils().select(connection, sql)
-        return rows
 
-    def _get_foreign_keys(self, connection):
-        sql = """
-        select distinct 
-          tc.table_schema, tc.table_name, kcu.column_name, c.data_type, 
-          ccu.table_schema as foreign_table_schema, 
-          ccu.table_name as foreign_table_name, ccu.column_name as foreign_column_name, tc.constraint_name,
-          rco.match_option, rco.update_rule, rco.delete_rule
-        from information_schema.table_constraints as tc
-        inner join information_schema.key_column_usage kcu 
-        on tc.constraint_schema = kcu.constraint_schema and tc.constraint_name = kcu.constraint_name
-        inner join information_schema.constraint_column_usage ccu 
-        on tc.constraint_schema = ccu.constraint_schema and tc.constraint_name = ccu.constraint_name
-        inner join information_schema.columns c 
-        on tc.table_schema = c.table_schema and tc.table_name = c.table_name and kcu.column_name = c.column_name
-        inner join information_schema.referential_constraints rco 
-        on tc.constraint_schema = rco.constraint_schema and tc.constraint_name = rco.constraint_name
-        where constraint_type = 'FOREIGN KEY'
-        and data_type in ('integer', 'bigint')
-        and tc.table_schema not in ('pg_catalog');
+class ReverseIdReplacer(SingleRewriteIdReplacer):
+    """
+    Undo a conversion: change the uuid PK and FK columns back to integers, from the serial columns kept by the
+    conversion, rewriting each table once.
+
+    The uuid PKs of the tables that have the serial column are converted, with the uuid FKs referencing them. A
+    mapping (uuid => old id) is built for each PK table; the rows inserted after the conversion (without old id)
+    receive new ids from the sequence of the table. Then a single "alter table" per table changes the PK and FK
+    columns back to the type of the serial column, looking up the mapping, and drops the serial column. The
+    sequence is the default value of the PK again.
+    """
+    JOURNAL_NAME = 'pk2uuid_reverse_journal'
+
+    def __init__(self):
+        super().__init__()
+        self.serial_name = None
+
+    def execute(self, *args, **kwargs):
+        params = kwargs.get('params')
+        if params is not None and (params.get('verify') or params.get('mapping_dir')):
+            raise Exception('ReverseIdReplacer does not support verify nor mapping_dir')
+        super().execute(*args, **kwargs)
+
+    def _discover(self, conn, journal=None, snapshot_file=None, params=None):
         """
-        rows = DatabaseUtils().select(connection, sql)
-        return rows
+        The keys depend on the serial column: its name is read from the params.
+        """
+        if params is not None:
+            self.serial_name = params['serial_name']
+        super()._discover(conn, journal, snapshot_file, params)
 
-    def _build_temp_column_name(self, column_name):
-        return '%s_temp2replace' % column_name
+    def _replace(self, conn, *args, **kwargs):
+        params = kwargs['params']
+        sequences = self._load_or_record(
+            conn, kwargs['utils'].journal, 'sequences',
+            lambda connection: self._get_sequences(connection, params['serial_name'])
+        )
 
-    def _build_table_name(self, schema_name, table_name):
-        return '%s.%s' % (schema_name, table_name)
+        if params.get('rebuild_indexes'):
+            kwargs['rows'] = self.schema_graph.indexes
+            self._run_phase(conn, "Dropping secondary indexes", self._drop_index, *args, **kwargs)
 
-    def _build_sql_to_create_column(self, table_name, column_name, data_type):
-        sql = 'alter table {table_name} add column if not exists "{column_name}" {data_type};'.format(
-            table_name=table_name,
-            column_name=column_name,
-            data_type=data_type,
+        kwargs['rows'] = self.primary_keys
+        self._run_phase(
+            conn, "Creating reverse id mapping tables", self._create_reverse_mapping, *args, **kwargs,
+            sequences=sequences
+        )
+
+        kwargs['rows'] = self.foreign_keys
+        self._run_phase(
+            conn, "Dropping fk constraints", self._drop_fk_constraint, *args, **kwargs, parallel=False
+        )
+
+        kwargs['rows'] = self._build_conversion_plan()
+        self._run_phase(conn, "Rewriting tables", self._rewrite_tables, *args, **kwargs, sequences=sequences)
+
+        self._recreate_fk_constraints(conn, *args, **kwargs)
+
+        kwargs['rows'] = self.primary_keys
+        self._run_phase(conn, "Drop reverse id mapping tables", self._drop_reverse_mapping, *args, **kwargs)
+
+        if params.get('rebuild_indexes'):
+            self._recreate_indexes(conn, *args, **kwargs)
+
+    def _build_sql_to_get_keys(self):
+        """
+        The uuid (single column) primary keys of the tables with the serial column, and the uuid foreign keys
+        referencing them. The data type is the one of the serial column (of the referenced table, for the FKs).
+        """
+        if self.serial_name is None:
+            raise Exception('The keys of ReverseIdReplacer depend on the serial column: discover them with params')
+        sql = """
+        select
+          c.contype as kind, t.oid as table_oid, n.nspname as table_schema, t.relname as table_name,
+          a.attname as column_name, format_type(s.atttypid, s.atttypmod) as data_type, c.conname as constraint_name,
+          ft.oid as foreign_table_oid, fn.nspname as foreign_table_schema, ft.relname as foreign_table_name,
+          fa.attname as foreign_column_name,
+          case c.confmatchtype when 'f' then 'FULL' when 'p' then 'PARTIAL' else 'SIMPLE' end as match_option,
+          case c.confupdtype
+            when 'r' then 'RESTRICT' when 'c' then 'CASCADE' when 'n' then 'SET NULL' when 'd' then 'SET DEFAULT'
+            else 'NO ACTION'
+          end as update_rule,
+          case c.confdeltype
+            when 'r' then 'RESTRICT' when 'c' then 'CASCADE' when 'n' then 'SET NULL' when 'd' then 'SET DEFAULT'
+            else 'NO ACTION'
+          end as delete_rule
+        from pg_constraint c
+        inner join pg_class t on t.oid = c.conrelid
+        inner join pg_namespace n on n.oid = t.relnamespace
+        inner join pg_attribute a on a.attrelid = c.conrelid and a.attnum = c.conkey[1]
+        inner join pg_attribute s
+          on s.attrelid = coalesce(nullif(c.confrelid, 0), c.conrelid) and s.attname = '{serial_name}'
+          and not s.attisdropped
+        left join pg_class ft on ft.oid = c.confrelid
+        left join pg_namespace fn on fn.oid = ft.relnamespace
+        left join pg_attribute fa on fa.attrelid = c.confrelid and fa.attnum = c.confkey[1]
+        where c.contype in ('p', 'f')
+        and array_length(c.conkey, 1) = 1
+        and c.conparentid = 0
+        and a.atttypid = 'uuid'::regtype
+        and s.atttypid in ('integer'::regtype, 'bigint'::regtype)
+        and n.nspname not in ('pg_catalog', 'information_schema')
+        order by n.nspname, t.relname, c.conname;
+        """.format(
+            serial_name=self.serial_name,
         )
         return sql
 
-    def _build_sql_to_drop_column(self, table_name, column_name):
-        sql = 'alter table {table_name} drop column if exists "{column_name}";'.format(
+    def _get_sequences(self, connection, serial_name):
+        """
+        The sequence of each PK table: the one owned by the serial column or by the PK column, if any.
+        :return: a dict table name => sequence name (or None).
+        """
+        sequences = {}
+        for row in self.primary_keys:
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            sql = """
+            select coalesce(
+              pg_get_serial_sequence('{table_name}', '{serial_name}'),
+              pg_get_serial_sequence('{table_name}', '{column_name}')
+            ) as sequence_name;
+            """.format(
+                table_name=table_name,
+                serial_name=serial_name,
+                column_name=row['column_name'],
+            )
+            sequences[table_name] = DatabaseUtils().select(connection, sql)[0]['sequence_name']
+        return sequences
+
+    def _build_sequence_name(self, row, sequences):
+        table_name = self._build_table_name(row['table_schema'], row['table_name'])
+        return sequences.get(table_name) or '%s."%s_%s_seq"' % (
+            row['table_schema'], row['table_name'], row['column_name']
+        )
+
+    def _build_reverse_mapping_table_name(self, table_schema, table_name):
+        return self._build_table_name(table_schema, '%s_uuid2id' % table_name)
+
+    def _build_reverse_mapping_function_name(self, table_schema, table_name):
+        return self._build_table_name(table_schema, '%s_uuid2id_lookup' % table_name)
+
+    def _build_sql_to_create_reverse_mapping(
+            self, table_name, column_name, serial_name, data_type, sequence_name, create_sequence, mapping_table_name,
+            mapping_function_name, unlogged=True
+    ):
+        sql = """
+        {create_sequence}
+        select setval('{sequence_name}', coalesce((select max("{serial_name}") from {table_name}), 0) + 1, false);
+        create {persistence}table if not exists {mapping_table_name} (
+          old_id uuid not null, new_id {data_type} not null
+        );
+        insert into {mapping_table_name} (old_id, new_id)
+        select "{column_name}", coalesce("{serial_name}", nextval('{sequence_name}')) from {table_name};
+        alter table {mapping_table_name} add primary key (old_id);
+        analyze {mapping_table_name};
+        create or replace function {mapping_function_name}(id uuid) returns {data_type}
+        language plpgsql stable as $$
+        declare
+          result {data_type};
+        begin
+          if id is null then
+            return null;
+          end if;
+          select new_id into result from {mapping_table_name} where old_id = id;
+          if result is null then
+            raise exception 'The uuid % is not in the id mapping {mapping_table_name}', id;
+          end if;
+          return result;
+        end $$;
+        """.format(
             table_name=table_name,
             column_name=column_name,
+            serial_name=serial_name,
+            data_type=data_type,
+            sequence_name=sequence_name,
+            create_sequence=(
+                'create sequence if not exists %s as %s;' % (sequence_name, data_type) if create_sequence else ''
+            ),
+            mapping_table_name=mapping_table_name,
+            mapping_function_name=mapping_function_name,
+            persistence='unlogged ' if unlogged else '',
         )
         return sql
 
-    def _create_serial_column(self, connection, *args, **kwargs):
-        column_name = kwargs['params']['serial_name']
+    def _create_reverse_mapping(self, connection, *args, **kwargs):
+        """
+        Create, for each PK table, a table (uuid => old id) and a lookup function over it. The rows without old id
+        (inserted after the conversion) receive new ids from the sequence of the table, created when missing.
+        """
+        serial_name = kwargs['params']['serial_name']
+        sequences = kwargs['sequences']
         rows = kwargs['rows']
         utils = kwargs['utils']
-
+        unlogged = self._is_unlogged_scratch(kwargs['params'])
         for row in rows:
-            schema_name = row['table_schema']
-            table_name = row['table_name']
-            data_type = row['data_type']
-            table_name = self._build_table_name(schema_name, table_name)
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            mapping_table_name = self._build_reverse_mapping_table_name(row['table_schema'], row['table_name'])
 
-            Utils.print_message("...adding serial column " + table_name)
+            Utils.print_message("...creating reverse id mapping " + mapping_table_name)
 
-            sql = self._build_sql_to_create_column(table_name, column_name, data_type)
+            sql = self._build_sql_to_create_reverse_mapping(
+                table_name, row['column_name'], serial_name, row['data_type'],
+                self._build_sequence_name(row, sequences), sequences.get(table_name) is None, mapping_table_name,
+                self._build_reverse_mapping_function_name(row['table_schema'], row['table_name']), unlogged
+            )
             if sql is not None:
-                utils.execute(connection, sql)
+                utils.execute(connection, sql, table_name)
 
-    def _drop_pk_default_value(self, connection, *args, **kwargs):
+    def _build_sql_to_drop_reverse_mapping(self, mapping_table_name, mapping_function_name):
+        sql = """
+        drop function if exists {mapping_function_name}(uuid);
+        drop table if exists {mapping_table_name};
+        """.format(
+            mapping_table_name=mapping_table_name,
+            mapping_function_name=mapping_function_name,
+        )
+        return sql
+
+    def _drop_reverse_mapping(self, connection, *args, **kwargs):
         rows = kwargs['rows']
         utils = kwargs['utils']
         for row in rows:
-            schema_name = row['table_schema']
-            table_name = row['table_name']
-            table_name = self._build_table_name(schema_name, table_name)
-            column_name = row['column_name']
+            table_name = self._build_table_name(row['table_schema'], row['table_name'])
+            mapping_table_name = self._build_reverse_mapping_table_name(row['table_schema'], row['table_name'])
 
-            Utils.print_message("...dropping PK default value " + table_name + "  " + column_name)
+            Utils.print_message("...dropping reverse id mapping " + mapping_table_name)
 
-            sql = self._build_sql_to_drop_pk_default_value(table_name, column_name)
+            sql = self._build_sql_to_drop_reverse_mapping(
+                mapping_table_name, self._build_reverse_mapping_function_name(row['table_schema'], row['table_name'])
+            )
             if sql is not None:
-                utils.execute(connection, sql)
+                utils.execute(connection, sql, table_name)
 
-    def _build_sql_to_drop_pk_default_value(self, table_name, column_name):
-        sql = 'alter table {table_name} alter column "{column_name}" drop default;'.format(
+    def _build_pk_subcommands(self, row, serial_name, *args, **kwargs):
+        function_name = self._build_reverse_mapping_function_name(row['table_schema'], row['table_name'])
+        return [
+            'drop constraint "{constraint_name}"'.format(constraint_name=row['constraint_name']),
+            'alter column "{column_name}" drop default'.format(column_name=row['column_name']),
+            'alter column "{column_name}" type {data_type} using {function_name}("{column_name}")'.format(
+                column_name=row['column_name'],
+                data_type=row['data_type'],
+                function_name=function_name,
+            ),
+            'add constraint "{constraint_name}" primary key ("{column_name}")'.format(
+                constraint_name=row['constraint_name'],
+                column_name=row['column_name'],
+            ),
+            'drop column if exists "{serial_name}"'.format(serial_name=serial_name),
+        ]
+
+    def _build_fk_subcommands(self, row, *args, **kwargs):
+        function_name = self._build_reverse_mapping_function_name(
+            row['foreign_table_schema'], row['foreign_table_name']
+        )
+        return [
+            'alter column "{column_name}" type {data_type} using {function_name}("{column_name}")'.format(
+                column_name=row['column_name'],
+                data_type=row['data_type'],
+                function_name=function_name,
+            ),
+        ]
+
+    def _build_sql_to_disown_sequence(self, sequence_name):
+        sql = 'alter sequence {sequence_name} owned by none;'.format(sequence_name=sequence_name)
+        return sql
+
+    def _build_sql_to_restore_sequence(self, table_name, column_name, sequence_name):
+        sql = """
+        alter sequence {sequence_name} owned by {table_name}."{column_name}";
+        alter table {table_name} alter column "{column_name}" set default nextval('{sequence_name}'::regclass);
+        """.format(
             table_name=table_name,
             column_name=column_name,
+            sequence_name=sequence_name,
         )
         return sql
 
-    def _create_temporary_column(self, connection, *args, **kwargs):
+    def _rewrite_tables(self, connection, *args, **kwargs):
+        serial_name = kwargs['params']['serial_name']
+        sequences = kwargs['sequences']
         rows = kwargs['rows']
         utils = kwargs['utils']
-        for row in rows:
-            schema_name = row['table_schema']
-            table_name = row['table_name']
-            column_name = row['column_name']
-            table_name = self._build_table_name(schema_name, table_name)
-            column_name = self._build_temp_column_name(column_name)
-
-            Utils.print_message("...adding " + table_name + "." + column_name)
+        for plan in rows:
+            table_name = self._build_table_name(plan['table_schema'], plan['table_name'])
+            primary_key = plan['primary_key']
+            statements = []
+            subcommands = []
 
-            sql = self._build_sql_to_create_column(table_name, column_name, 'UUID')
-            if sql is not None:
-                utils.execute(connection, sql)
+            if primary_key is not None:
+                # the sequence may be owned by the serial column, which is dropped
+                sql = self._build_sql_to_disown_sequence(self._build_sequence_name(primary_key, sequences))
+                if sql is not None:
+                    statements.append(sql)
+                subcommands.extend(self._build_pk_subcommands(primary_key, serial_name, *args, **kwargs))
 
-    def _drop_temporary_column(self, connection, *args, **kwargs):
-        rows = kwargs['rows']
-        utils = kwargs['utils']
-        for row in rows:
-            schema_name = row['table_schema']
-            table_name = row['table_name']
-            column_name = row['column_name']
+            for row in plan['foreign_keys']:
+                subcommands.extend(self._build_fk_subcommands(row, *args, **kwargs))
 
-            table_name = self._build_table_name(schema_name, table_name)
-            column_name = self._build_temp_column_name(column_name)
+            if not subcommands:
+                continue
 
-            Utils.print_message("...dropping temporary column " + table_name + "." + column_name)
+            Utils.print_message("...rewriting " + table_name)
 
-            sql = self._build_sql_to_drop_column(table_name, column_name)
+            sql = self._build_sql_to_rewrite_table(table_name, subcommands)
             if sql is not None:
-                utils.execute(connection, sql)
+                statements.append(sql)
+
+            if primary_key is not None:
+                sql = self._build_sql_to_restore_sequence(
+                    table_name, primary_key['column_name'], self._build_sequence_name(primary_key, sequences)
+                )
+                if sql is not None:
+                    statements.append(sql)
+            if statements:
+                # one command string: the sequence is never left without owner, nor the table half converted
+                utils.execute(connection, ''.join(statements), table_name)